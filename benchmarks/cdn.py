@@ -0,0 +1,141 @@
+import asyncio
+import io
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+from aiohttp import web
+from PIL import Image
+
+# every 127.0.0.x address reaches the loopback interface on linux, each one is
+# a separate host to dct (own connections, rate limits and request profiles)
+HOST_FORMAT = "127.0.0.{}"
+
+
+@dataclass
+class CdnSettings:
+    port: int = 8780
+    hosts: int = 4
+    # the last slow_hosts hosts answer after slow_latency instead of latency
+    slow_hosts: int = 1
+    latency: float = 0.02
+    slow_latency: float = 0.5
+    # every nth image request of a host is answered with a 429
+    rate_limit_every: int = 50
+    rate_limit_reset: float = 1.0
+    # discord refresh bucket: refresh_limit requests per refresh_window seconds
+    refresh_limit: int = 5
+    refresh_window: float = 1.0
+    image_size: int = 256
+    variants: int = 32
+    seed: int = 1
+
+
+def get_hosts(settings: CdnSettings) -> list[str]:
+    return [HOST_FORMAT.format(host + 1) for host in range(settings.hosts)]
+
+
+def make_image(size: int, seed: int) -> bytes:
+    # noise does not compress, the png is close to size * size * 3 bytes
+    rng = random.Random(seed)
+    image = Image.frombytes("RGB", (size, size), rng.randbytes(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class FakeCdn:
+    def __init__(self, settings: CdnSettings):
+        self.settings = settings
+        self.images = [
+            make_image(settings.image_size, settings.seed + variant)
+            for variant in range(settings.variants)
+        ]
+        self.slow = set(get_hosts(settings)[settings.hosts - settings.slow_hosts :])
+        self.stats = Counter()
+        self._host_requests = Counter()
+        self._bucket_reset = 0.0
+        self._bucket_remaining = settings.refresh_limit
+
+    def get_image(self, name: str) -> bytes:
+        return self.images[sum(name.encode()) % len(self.images)]
+
+    async def serve_image(self, request: web.Request, kind: str) -> web.Response:
+        host = request.host.split(":")[0]
+        self.stats[f"{kind}_requests"] += 1
+        self._host_requests[host] += 1
+        await asyncio.sleep(
+            self.settings.slow_latency if host in self.slow else self.settings.latency
+        )
+        every = self.settings.rate_limit_every
+        if every and self._host_requests[host] % every == 0:
+            self.stats["429"] += 1
+            return web.Response(
+                status=429,
+                headers={
+                    "X-RateLimit-Limit": "8",
+                    "X-RateLimit-Reset-After": str(self.settings.rate_limit_reset),
+                },
+            )
+        body = self.get_image(request.match_info["name"])
+        self.stats["bytes_out"] += len(body)
+        return web.Response(body=body, content_type="image/png")
+
+    async def cdn(self, request: web.Request) -> web.Response:
+        return await self.serve_image(request, "cdn")
+
+    async def discord_cdn(self, request: web.Request) -> web.Response:
+        return await self.serve_image(request, "discord_cdn")
+
+    async def refresh(self, request: web.Request) -> web.Response:
+        self.stats["refresh_requests"] += 1
+        await asyncio.sleep(self.settings.latency)
+        now = time.monotonic()
+        if self._bucket_reset <= now:
+            self._bucket_reset = now + self.settings.refresh_window
+            self._bucket_remaining = self.settings.refresh_limit
+        self._bucket_remaining -= 1
+        reset_after = f"{self._bucket_reset - now:.3f}"
+        headers = {
+            "X-RateLimit-Bucket": "refresh-urls",
+            "X-RateLimit-Limit": str(self.settings.refresh_limit),
+            "X-RateLimit-Remaining": str(max(0, self._bucket_remaining)),
+            "X-RateLimit-Reset-After": reset_after,
+        }
+        if self._bucket_remaining < 0:
+            self.stats["refresh_429"] += 1
+            return web.json_response(
+                {"message": "You are being rate limited.", "global": False},
+                status=429,
+                headers={**headers, "Retry-After": reset_after},
+            )
+        urls = (await request.json())["attachment_urls"]
+        expires = int(time.time()) + 86400
+        refreshed = [
+            {"original": url, "refreshed": f"{url}?ex={expires:x}&is=0&hm=0"}
+            for url in urls
+        ]
+        return web.json_response({"refreshed_urls": refreshed}, headers=headers)
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/cdn/{name}", self.cdn)
+        app.router.add_get(
+            "/discordapp/attachments/{channel}/{attachment}/{name}", self.discord_cdn
+        )
+        app.router.add_post("/api/attachments/refresh-urls", self.refresh)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+
+def run_cdn(settings: CdnSettings) -> None:
+    web.run_app(
+        FakeCdn(settings).app(),
+        host=get_hosts(settings),
+        port=settings.port,
+        print=None,
+        access_log=None,
+    )
@@ -0,0 +1,132 @@
+import argparse
+import base64
+import json
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Callable
+import dct.json as codec
+from dct.compress import COMPRESS_FORMATS
+from dct.config import Config
+from dct.console import console
+
+
+def make_project(size: int, embed_share: float) -> Any:
+    # rows of choices with text and links, part of the size as base64 embeds
+    random.seed(1)
+    embed_size = 1 << 18
+    embeds = int(size * embed_share) // embed_size
+    rows, objects, total = [], [], 0
+    while total < size:
+        i = len(objects)
+        if embeds and i % 50 == 0:
+            embeds -= 1
+            image = "data:image/png;base64," + base64.b64encode(
+                random.randbytes(embed_size * 3 // 4)
+            ).decode("ascii")
+        else:
+            image = f"https://example.com/{i}.png"
+        objects.append(
+            {
+                "id": f"obj{i}",
+                "title": f"Choice {i}",
+                "text": "Lorem ipsum dolor sit amet, café naïve. " * 8,
+                "image": image,
+                "requireds": [{"type": "id", "reqId": f"obj{i - 1}"}],
+                "scores": [{"id": "points", "value": i % 7, "ratio": i / 3}],
+                "isActive": False,
+            }
+        )
+        total += len(image) + 600
+        if len(objects) == 200:
+            rows.append({"id": f"row{len(rows)}", "image": "", "objects": objects})
+            objects = []
+    rows.append({"id": f"row{len(rows)}", "image": "", "objects": objects})
+    return {"rows": rows, "backpack": [], "styling": {"image": ""}}
+
+
+def baseline_read(path: str) -> Any:
+    # read_json and write_json up to v0.6.8, kept here as the baseline
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def baseline_write(path: str, data: Any, minify: bool) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        indent = None if minify else 2
+        separators = (",", ":") if minify else None
+        json.dump(data, f, indent=indent, separators=separators, sort_keys=True)
+
+
+def timed(function: Callable, *args: Any) -> tuple[float, Any]:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def bench(size_mb: int, embed_share: float) -> None:
+    # write_json reports its steps, only the timings are printed here
+    console.quiet = True
+    project = make_project(size_mb << 20, embed_share)
+    codecs = ["json"] + (["orjson"] if codec.orjson is not None else [])
+    fast = codec.orjson
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "project.json")
+        output = os.path.join(directory, "project_new.json")
+        baseline_write(path, project, True)
+        size = os.path.getsize(path) / (1 << 20)
+        print(f"project: {size:.0f} MB")
+        del project
+        data = None
+        read, data = timed(baseline_read, path)
+        print(f"read   baseline: {read:6.2f}s")
+        for name in codecs:
+            codec.orjson = fast if name == "orjson" else None
+            data = None
+            read, data = timed(codec.read_json, path)
+            print(f"read   {name:>8}: {read:6.2f}s")
+        for minify in (True, False):
+            mode = "minified" if minify else "pretty"
+            write, _ = timed(baseline_write, output, data, minify)
+            print(f"write  baseline {mode}: {write:6.2f}s")
+            for name in codecs:
+                codec.orjson = fast if name == "orjson" else None
+                for sort_keys in (True, False):
+                    config = SimpleNamespace(
+                        OUTPUT_PATH=output,
+                        MINIFY=minify,
+                        SORT_KEYS=sort_keys,
+                        COMPRESS_OUTPUT="",
+                    )
+                    write, _ = timed(codec.write_json, config, data)
+                    sort = "sorted" if sort_keys else "input order"
+                    print(f"write  {name:>8} {mode} {sort}: {write:6.2f}s")
+                for compress_format in COMPRESS_FORMATS:
+                    config = Config(
+                        OUTPUT_DIRECTORY=directory,
+                        OUTPUT_FILE="project_new.json",
+                        MINIFY=minify,
+                        COMPRESS_OUTPUT=compress_format,
+                    )
+                    write, _ = timed(codec.write_json, config, data)
+                    compressed = os.path.getsize(f"{output}.{compress_format}")
+                    print(
+                        f"write  {name:>8} {mode} +{compress_format}: {write:6.2f}s "
+                        f"{compressed / (1 << 20):.1f} MB"
+                    )
+        codec.orjson = fast
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="read_json/write_json throughput")
+    parser.add_argument("--size", type=int, default=100, help="project size in MB")
+    parser.add_argument(
+        "--embeds",
+        type=float,
+        default=0.5,
+        help="share of the project size made of base64 embeds",
+    )
+    args = parser.parse_args()
+    bench(args.size, args.embeds)
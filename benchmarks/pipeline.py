@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import base64
+import inspect
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from functools import wraps
+from importlib import metadata
+from typing import Any, Callable
+import yaml
+from dct import core, discord
+from dct.console import console, set_headless
+from dct.pool import shutdown_pool
+from dct.cache import close_caches
+from dct.manifest import close_manifests
+from benchmarks.cdn import CdnSettings, get_hosts, make_image, run_cdn
+
+# the stages of dct.core.run_project, in the order they run
+STAGES = {
+    "read_json": "read",
+    "index_images": "read",
+    "index_stream": "read",
+    "process_project_url": "read",
+    "process_discord": "discord",
+    "process_base64": "base64",
+    "process_images": "download",
+    "image_to_base64": "embed",
+    "write_output": "write",
+}
+RSS_INTERVAL = 0.01
+
+
+def make_project(args: argparse.Namespace) -> tuple[dict, Counter]:
+    hosts = get_hosts(args.cdn)
+    port = args.cdn.port
+    embeds = [
+        "data:image/png;base64,"
+        + base64.b64encode(make_image(args.base64_size, variant)).decode("ascii")
+        for variant in range(args.cdn.variants)
+    ]
+    # objects are spread over the image kinds by share, the rest has no image
+    kinds = [
+        ("remote", args.remote),
+        ("discord", args.discord),
+        ("base64", args.base64),
+    ]
+    counts = Counter()
+    rows = []
+    for r in range(args.rows):
+        objects = []
+        for o in range(args.objects):
+            position = ((r * args.objects + o) * 0.618034) % 1
+            kind, image = "none", ""
+            for name, share in kinds:
+                if position < share:
+                    kind = name
+                    break
+                position -= share
+            host = hosts[(r * args.objects + o) % len(hosts)]
+            if kind == "remote":
+                image = f"http://{host}:{port}/cdn/{r}_{o}.png"
+            elif kind == "discord":
+                image = f"http://{host}:{port}/discordapp/attachments/{r}/{o}/{o}.png"
+            elif kind == "base64":
+                image = embeds[(r * args.objects + o) % len(embeds)]
+            counts[kind] += 1
+            objects.append(
+                {
+                    "id": f"obj{r}_{o}",
+                    "title": f"Choice {o}",
+                    "text": "Lorem ipsum dolor sit amet. " * 4,
+                    "image": image,
+                    "requireds": [{"type": "id", "reqId": f"obj{r}_{o - 1}"}],
+                    "scores": [{"id": "points", "value": o % 7}],
+                }
+            )
+        rows.append({"id": f"row{r}", "image": "", "objects": objects})
+    return {"rows": rows, "backpack": [], "styling": {"image": ""}}, counts
+
+
+def get_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak of the whole process, kilobytes on linux, bytes on macos
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_cdn_stats(port: int) -> Counter:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return Counter(json.loads(response.read()))
+
+
+class StageMeter:
+    def __init__(self, port: int):
+        self.port = port
+        self.stages = {}
+        self.peak = 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, get_rss())
+
+    def close(self) -> None:
+        self._stop.set()
+        self._sampler.join()
+
+    def _start(self) -> tuple[float, Counter]:
+        self.peak = get_rss()
+        return time.perf_counter(), get_cdn_stats(self.port)
+
+    def _stop_stage(self, name: str, started: tuple[float, Counter]) -> None:
+        seconds = time.perf_counter() - started[0]
+        requests = get_cdn_stats(self.port)
+        requests.subtract(started[1])
+        stage = self.stages.setdefault(
+            name, {"seconds": 0.0, "peak_rss_mb": 0.0, "requests": Counter()}
+        )
+        stage["seconds"] += seconds
+        stage["peak_rss_mb"] = max(
+            stage["peak_rss_mb"], max(self.peak, get_rss()) / 2**20
+        )
+        stage["requests"].update(+requests)
+
+    def wrap(self, name: str, function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+
+            @wraps(function)
+            async def measured_async(*args: Any, **kwargs: Any) -> Any:
+                started = self._start()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self._stop_stage(name, started)
+
+            return measured_async
+
+        @wraps(function)
+        def measured(*args: Any, **kwargs: Any) -> Any:
+            started = self._start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._stop_stage(name, started)
+
+        return measured
+
+
+async def run_pass(config: dict, directory: str, meter: StageMeter) -> int:
+    yaml_path = os.path.join(directory, f"{config['OUTPUT_FILE']}.yaml")
+    with open(yaml_path, "w") as f:
+        yaml.safe_dump(config, f)
+    originals = {name: getattr(core, name) for name in STAGES}
+    for name, stage in STAGES.items():
+        setattr(core, name, meter.wrap(stage, originals[name]))
+    try:
+        # headless progress events go to stdout, only the results are printed
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            return await core.main(
+                argparse.Namespace(config=yaml_path, resume=False, headless=True)
+            )
+    finally:
+        for name, function in originals.items():
+            setattr(core, name, function)
+        shutdown_pool()
+        close_caches()
+        close_manifests()
+
+
+def get_throughput(name: str, stage: dict, counts: Counter, sizes: dict) -> dict:
+    items = {
+        "read": counts.total(),
+        "discord": counts["discord"],
+        "base64": counts["base64"],
+        "download": counts["remote"],
+        "embed": counts["remote"] + counts["discord"] + counts["base64"],
+        "write": counts.total(),
+    }[name]
+    size = {"read": sizes["input"], "write": sizes["output"]}.get(name, 0)
+    size += stage["requests"].get("bytes_out", 0)
+    seconds = stage["seconds"] or 1e-9
+    return {
+        "stage": name,
+        "seconds": round(stage["seconds"], 3),
+        "items": items,
+        "items_per_second": round(items / seconds, 1),
+        "mb": round(size / 2**20, 2),
+        "mb_per_second": round(size / 2**20 / seconds, 2),
+        "peak_rss_mb": round(stage["peak_rss_mb"], 1),
+        "requests": dict(stage["requests"]),
+    }
+
+
+def get_environment() -> dict:
+    try:
+        version = metadata.version("dct")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "dct": version,
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def wait_for_cdn(port: int) -> None:
+    for _ in range(200):
+        try:
+            get_cdn_stats(port)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"fake cdn did not start on port {port}")
+
+
+def bench(args: argparse.Namespace) -> dict:
+    console.quiet = True
+    set_headless(True)
+    # refresh requests go to the fake cdn instead of discord
+    discord.REFRESH_URL = (
+        f"http://127.0.0.1:{args.cdn.port}/api/attachments/refresh-urls"
+    )
+    server = multiprocessing.Process(target=run_cdn, args=(args.cdn,), daemon=True)
+    server.start()
+    meter = StageMeter(args.cdn.port)
+    passes = []
+    try:
+        wait_for_cdn(args.cdn.port)
+        project, counts = make_project(args)
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "project.json"), "w") as f:
+                json.dump(project, f)
+            del project
+            config = {
+                "INPUT_DIRECTORY": directory,
+                "OUTPUT_DIRECTORY": directory,
+                "PROJECT_FILE": "project.json",
+                "OUTPUT_FILE": "project_new.json",
+                "PROCESS_DISCORD_LINKS": True,
+                "TOKEN": "benchmark",
+                "BASE64_TO_IMAGE": True,
+                "DOWNLOAD_IMAGES": True,
+                "CONVERT_IMAGES": args.convert,
+                "STREAM_JSON": args.stream,
+                "MINIFY": True,
+                **args.set,
+            }
+            runs = [("process", config)]
+            if args.embed:
+                embed_config = {
+                    **config,
+                    "PROJECT_FILE": "project_new.json",
+                    "OUTPUT_FILE": "project_embedded.json",
+                    "PROCESS_DISCORD_LINKS": False,
+                    "BASE64_TO_IMAGE": False,
+                    "DOWNLOAD_IMAGES": False,
+                    "IMAGE_TO_BASE64": True,
+                }
+                runs.append(("embed", embed_config))
+            for name, run_config in runs:
+                meter.stages = {}
+                started = time.perf_counter()
+                exit_code = asyncio.run(run_pass(run_config, directory, meter))
+                total = time.perf_counter() - started
+                sizes = {
+                    "input": os.path.getsize(
+                        os.path.join(directory, run_config["PROJECT_FILE"])
+                    ),
+                    "output": os.path.getsize(
+                        os.path.join(directory, run_config["OUTPUT_FILE"])
+                    ),
+                }
+                passes.append(
+                    {
+                        "pass": name,
+                        "exit_code": exit_code,
+                        "seconds": round(total, 3),
+                        "stages": [
+                            get_throughput(stage, meter.stages[stage], counts, sizes)
+                            for stage in dict.fromkeys(STAGES.values())
+                            if stage in meter.stages
+                        ],
+                    }
+                )
+    finally:
+        meter.close()
+        server.terminate()
+        server.join()
+    params = {key: value for key, value in vars(args).items() if key != "cdn"}
+    return {
+        "environment": get_environment(),
+        "params": {**params, "cdn": vars(args.cdn)},
+        "images": dict(counts),
+        "peak_rss_mb": round(get_rss_peak() / 2**20, 1),
+        # largest pool worker (and fake cdn) process, the stage figures only
+        # cover the dct process itself
+        "children_peak_rss_mb": round(
+            get_rss_peak(resource.RUSAGE_CHILDREN) / 2**20, 1
+        ),
+        "passes": passes,
+    }
+
+
+def get_rss_peak(who: int = resource.RUSAGE_SELF) -> int:
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def print_results(results: dict, baseline: dict | None) -> None:
+    stages = {}
+    if baseline:
+        for run in baseline["passes"]:
+            for stage in run["stages"]:
+                stages[run["pass"], stage["stage"]] = stage
+    for run in results["passes"]:
+        print(f"{run['pass']} (exit {run['exit_code']}): {run['seconds']:.2f}s")
+        for stage in run["stages"]:
+            requests = sum(
+                count
+                for name, count in stage["requests"].items()
+                if name.endswith("requests")
+            )
+            line = (
+                f"  {stage['stage']:<9}{stage['seconds']:8.2f}s "
+                f"{stage['items_per_second']:10.1f} items/s "
+                f"{stage['mb_per_second']:8.2f} MB/s "
+                f"{stage['peak_rss_mb']:8.1f} MB rss {requests:6d} requests "
+                f"({stage['requests'].get('429', 0) + stage['requests'].get('refresh_429', 0)} 429)"
+            )
+            old = stages.get((run["pass"], stage["stage"]))
+            if old and old["seconds"]:
+                change = (stage["seconds"] - old["seconds"]) / old["seconds"]
+                line += f"  time {change:+.0%} vs baseline"
+            print(line)
+    print(
+        f"peak rss: {results['peak_rss_mb']:.1f} MB, "
+        f"child processes: {results['children_peak_rss_mb']:.1f} MB"
+    )
+
+
+def parse_set(value: str) -> tuple[str, Any]:
+    key, _, raw = value.partition("=")
+    return key, yaml.safe_load(raw)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="dct pipeline benchmark against a local fake cdn"
+    )
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--objects", type=int, default=50)
+    parser.add_argument("--remote", type=float, default=0.4, help="share of objects")
+    parser.add_argument("--discord", type=float, default=0.2, help="share of objects")
+    parser.add_argument("--base64", type=float, default=0.2, help="share of objects")
+    parser.add_argument(
+        "--base64-size", type=int, default=128, help="side of embedded images in px"
+    )
+    parser.add_argument(
+        "--image-size", type=int, default=256, help="side of served images in px"
+    )
+    parser.add_argument(
+        "--variants", type=int, default=32, help="distinct images and embeds"
+    )
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--slow-hosts", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--slow-latency", type=float, default=0.5)
+    parser.add_argument(
+        "--rate-limit-every",
+        type=int,
+        default=50,
+        help="answer every nth image request of a host with a 429 (0: never)",
+    )
+    parser.add_argument("--refresh-limit", type=int, default=5)
+    parser.add_argument("--refresh-window", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=8780)
+    parser.add_argument("--convert", action="store_true", help="CONVERT_IMAGES")
+    parser.add_argument("--stream", action="store_true", help="STREAM_JSON")
+    parser.add_argument(
+        "--embed", action="store_true", help="run an IMAGE_TO_BASE64 pass afterwards"
+    )
+    parser.add_argument(
+        "--set",
+        type=parse_set,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra config parameter, e.g. --set WORKER_MODE=thread",
+    )
+    parser.add_argument("--output", default="pipeline_results.json")
+    parser.add_argument("--compare", default="", help="earlier results file")
+    args = parser.parse_args()
+    args.set = dict(args.set)
+    args.cdn = CdnSettings(
+        port=args.port,
+        hosts=args.hosts,
+        slow_hosts=min(args.slow_hosts, args.hosts),
+        latency=args.latency,
+        slow_latency=args.slow_latency,
+        rate_limit_every=args.rate_limit_every,
+        refresh_limit=args.refresh_limit,
+        refresh_window=args.refresh_window,
+        image_size=args.image_size,
+        variants=args.variants,
+    )
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    results = bench(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_results(results, baseline)
+    print(f"results written to {args.output}")
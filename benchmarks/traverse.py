@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import time
+from typing import Any, Callable
+from dct.json import traverse_json
+
+
+async def recursive_traverse_json(
+    data: Any, processing_function: Callable, *args: tuple, **kwargs: dict[str, Any]
+) -> Any:
+    # the walker used up to v0.6.8, kept here as the baseline
+    if isinstance(data, dict):
+        await processing_function(data, *args, **kwargs)
+        for value in data.values():
+            if isinstance(value, (dict, list)):
+                await recursive_traverse_json(
+                    value, processing_function, *args, **kwargs
+                )
+    elif isinstance(data, list):
+        for item in data:
+            await recursive_traverse_json(item, processing_function, *args, **kwargs)
+
+
+def make_project(rows: int, objects: int) -> tuple[dict, int]:
+    project = {
+        "rows": [
+            {
+                "id": f"row{r}",
+                "image": "",
+                "objects": [
+                    {
+                        "id": f"obj{r}_{o}",
+                        "image": f"https://example.com/{r}/{o}.png",
+                        "requireds": [{"type": "id", "reqId": f"obj{r}_{o - 1}"}],
+                        "scores": [{"id": "points", "value": o}],
+                        "addons": [{"image": "", "text": "addon"}],
+                    }
+                    for o in range(objects)
+                ],
+            }
+            for r in range(rows)
+        ],
+        "backpack": [],
+        "styling": {"image": ""},
+    }
+    nodes = 0
+
+    def count(data: dict) -> None:
+        nonlocal nodes
+        nodes += 1
+
+    traverse_json(project, count)
+    return project, nodes
+
+
+def make_deep(depth: int) -> dict:
+    project = {"image": ""}
+    for _ in range(depth):
+        project = {"image": "", "children": [project]}
+    return project
+
+
+def bench(rows: int, objects: int, repeat: int) -> None:
+    project, nodes = make_project(rows, objects)
+
+    def visit(data: dict) -> None:
+        data.get("image", "")
+
+    async def async_visit(data: dict) -> None:
+        data.get("image", "")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        asyncio.run(recursive_traverse_json(project, async_visit))
+    recursive = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        traverse_json(project, visit)
+    iterative = time.perf_counter() - start
+
+    print(f"dicts per walk: {nodes}")
+    print(f"recursive async: {nodes * repeat / recursive:,.0f} dicts/s")
+    print(f"iterative sync:  {nodes * repeat / iterative:,.0f} dicts/s")
+
+    deep = make_deep(100_000)
+    try:
+        asyncio.run(recursive_traverse_json(deep, async_visit))
+        print("recursive async: depth 100000 ok")
+    except RecursionError:
+        print("recursive async: depth 100000 RecursionError")
+    traverse_json(deep, visit)
+    print("iterative sync:  depth 100000 ok")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="traverse_json throughput")
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--objects", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    bench(args.rows, args.objects, args.repeat)
@@ -1,59 +1,140 @@
 import asyncio
 import os
 import base64
-import io
+import mmap
+from functools import partial
 from dct.console import (
     console,
     create_progress_bar,
     create_panel_layout,
     create_live,
+    report_failures,
 )
-from dct.image import save_images, open_images
-from dct.json import get_base64_strings
+from dct.image import write_image, get_image_format, HEADER_SIZE
+from dct.json import get_base64_slots
+from dct.index import ImageIndex, ImageSlot
+from dct.stream import StreamIndex, FileEmbed
 from dct.config import Config
-from dct.paths import get_images
+from dct.paths import get_images, local_image_exists
+from dct.hash import hash_bytes
+from dct.pool import run_in_pool, get_workers
+from dct.manifest import get_manifest, BASE64_STAGE, DONE, FAILED
+from dct.semaphore import DynamicSemaphore
+from dct.metrics import busy, record
 
+MMAP_SIZE = 1 << 20
 
-def decode_base64(base64_string: str) -> bytes:
-    return base64.b64decode(base64_string.split(",")[1])
 
+def decode_base64(base64_string: str | bytes) -> bytes:
+    start = base64_string.index("," if isinstance(base64_string, str) else b",") + 1
+    if isinstance(base64_string, str):
+        return base64.b64decode(base64_string[start:])
+    return base64.b64decode(memoryview(base64_string)[start:])
 
-def encode_base64(image_bytes: io.BytesIO) -> str:
-    return base64.b64encode(image_bytes.getvalue()).decode("utf-8")
 
+def get_base64_extension(base64_string: str) -> str:
+    # only look at the "data:image/png;base64" header, never split the payload
+    header = base64_string[: base64_string.index(",")]
+    return header.split(";")[0].split("/")[1]
 
-async def image_to_base64(config: Config) -> dict | None:
+
+def file_to_base64(image_path: str) -> str:
+    with open(image_path, "rb") as f:
+        image_format = get_image_format(f.read(HEADER_SIZE), image_path)
+        if os.fstat(f.fileno()).st_size < MMAP_SIZE:
+            f.seek(0)
+            encoded = base64.b64encode(f.read())
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                encoded = base64.b64encode(data)
+    return f"data:image/{image_format};base64," + encoded.decode("ascii")
+
+
+async def embed_image(
+    slots: list[ImageSlot],
+    image_path: str,
+    stream: bool,
+    config: Config,
+    semaphore: DynamicSemaphore,
+) -> bool:
+    async with semaphore:
+        try:
+            with busy("embed"):
+                if stream:
+                    with open(image_path, "rb") as f:
+                        image_format = get_image_format(f.read(HEADER_SIZE), image_path)
+                    image = FileEmbed(image_path, image_format)
+                else:
+                    image = await run_in_pool(config, file_to_base64, image_path)
+        except Exception as e:
+            config.LOGGER.debug(f"Failed to embed {image_path}: {str(e)}")
+            return False
+    size = os.path.getsize(image_path)
+    # streamed embeds are only encoded while the output is written
+    encoded = len(image) if isinstance(image, str) else (size + 2) // 3 * 4
+    record("embed", items=1, bytes_in=size, bytes_out=encoded)
+    for slot in slots:
+        slot.set(image)
+    return True
+
+
+async def image_to_base64(index: ImageIndex, config: Config) -> None:
     image_paths = await get_images(config)
 
     if len(image_paths) == 0:
         console.print(f"[bold red]No images found in path: {config.IMAGE_PATH}")
         return
 
-    base64_map = {}
+    # group slots by the image they point to so each file is encoded once
+    image_slots = {}
+    for slot in index:
+        if slot.hash_key in image_paths:
+            image_slots.setdefault(slot.hash_key, []).append(slot)
 
     convert_progress = create_progress_bar()
     task = convert_progress.add_task(
-        "Converting Images to Base64", total=len(image_paths)
+        "Converting Images to Base64", total=len(image_slots)
     )
     live_panel = create_live(create_panel_layout(convert_progress, 1))
 
+    semaphore = DynamicSemaphore(get_workers(config) * 2, "embed")
+    stream = isinstance(index, StreamIndex)
+
     with live_panel:
-        for hash_key, image_path in image_paths.items():
-            image_data, image_ext = await open_images(image_path)
-            base64_encoded_string = encode_base64(image_data)
-            base64_map[hash_key] = (
-                f"data:image/{image_ext};base64," + base64_encoded_string
+        tasks = [
+            embed_image(
+                slots,
+                os.path.join(config.OUTPUT_DIRECTORY, image_paths[hash_key]),
+                stream,
+                config,
+                semaphore,
             )
-            convert_progress.update(task, advance=1)
-
-    return base64_map
+            for hash_key, slots in image_slots.items()
+        ]
+        for coro in asyncio.as_completed(tasks):
+            if await coro:
+                convert_progress.update(task, advance=1)
+            else:
+                report_failures(convert_progress, task)
+
+
+def base64_to_file(
+    image_string: str, image_name: str, config: Config, original_extension: str
+) -> str:
+    image = decode_base64(image_string)
+    if config.CONTENT_ADDRESSED:
+        image_name = f"image_{hash_bytes(image)}{os.path.splitext(image_name)[1]}"
+    image_path = os.path.join(config.IMAGE_PATH, image_name)
+    # animations are named after the format they were written in
+    return os.path.basename(write_image(image, image_path, config, original_extension))
 
 
 async def base64_to_image(
-    image_string: str, key: str, config: Config, semaphore: asyncio.Semaphore
+    slot: ImageSlot, key: str, config: Config, semaphore: DynamicSemaphore
 ) -> dict[str, str]:
     async with semaphore:
-        original_extension = image_string.split(";")[0].split("/")[1].upper()
+        image_string = slot.value
+        original_extension = get_base64_extension(image_string).upper()
         if original_extension.lower() == "svg+xml":
             original_extension = "svg"
         if not config.CONVERT_IMAGES or original_extension == "svg":
@@ -61,38 +142,72 @@ async def base64_to_image(
         else:
             image_format = config.IMAGE_FORMAT
 
-        image_data = decode_base64(image_string)
         image_name = f"image_{key}.{image_format.lower()}"
-        image_path = os.path.join(config.IMAGE_PATH, image_name)
-        await save_images(image_data, image_path, config, original_extension)
+        try:
+            with busy("base64"):
+                image_name = await run_in_pool(
+                    config,
+                    base64_to_file,
+                    image_string,
+                    image_name,
+                    config,
+                    original_extension,
+                )
+        except Exception as e:
+            config.LOGGER.debug(f"Failed to convert base64 image for {key}: {str(e)}")
+            get_manifest(config).record(BASE64_STAGE, key, "", FAILED)
+            return {}
 
     url = os.path.join(config.IMAGE_FOLDER, image_name)
+    record(
+        "base64",
+        items=1,
+        bytes_in=len(image_string),
+        bytes_out=os.path.getsize(os.path.join(config.IMAGE_PATH, image_name)),
+    )
+    get_manifest(config).record(BASE64_STAGE, key, "", DONE, output=url)
     return {key: url}
 
 
-async def process_base64(json_data, config: Config) -> dict:
-    base64_strings = await get_base64_strings(json_data)
+async def process_base64(index: ImageIndex, config: Config) -> dict:
+    base64_slots = get_base64_slots(index)
 
-    if len(base64_strings) == 0:
+    if len(base64_slots) == 0:
         console.print("[bold red]No base64 embeds found...")
         return {}
 
+    # embeds are keyed by content hash, the payload itself is never journaled
+    finished, pending = get_manifest(config).split(
+        BASE64_STAGE,
+        dict.fromkeys(base64_slots, ""),
+        partial(local_image_exists, config),
+    )
+    if finished:
+        console.print(f"[blue]Resuming, {len(finished)} embeds already saved")
+
     base64_progress = create_progress_bar()
 
     task = base64_progress.add_task(
-        "Converting Base64 Images", total=len(base64_strings)
+        "Converting Base64 Images", total=len(base64_slots), completed=len(finished)
     )
     live_panel = create_live(create_panel_layout(base64_progress, 1))
 
-    base64_rate_limit = 15
-    semaphore = asyncio.Semaphore(base64_rate_limit)
+    # keep every worker busy while bounding how many payloads are in flight
+    semaphore = DynamicSemaphore(get_workers(config) * 2, "base64")
 
     with live_panel:
+        tasks = [
+            base64_to_image(base64_slots[key], key, config, semaphore)
+            for key in pending
+        ]
         results = []
-        for key, image_string in base64_strings.items():
-            result = await base64_to_image(image_string, key, config, semaphore)
+        for coro in asyncio.as_completed(tasks):
+            result = await coro
             results.append(result)
-            base64_progress.update(task, advance=1)
+            if result:
+                base64_progress.update(task, advance=1)
+            else:
+                report_failures(base64_progress, task)
 
-    new_urls = {k: v for r in results for k, v in r.items()}
+    new_urls = finished | {k: v for r in results for k, v in r.items()}
     return new_urls
@@ -0,0 +1,148 @@
+import sqlite3
+import time
+from dataclasses import dataclass
+from dct.config import Config
+
+
+@dataclass(frozen=True)
+class HttpEntry:
+    url: str
+    etag: str
+    last_modified: str
+    size: int
+    content_hash: str
+    image_name: str
+
+
+@dataclass(frozen=True)
+class RefreshEntry:
+    attachment: str
+    url: str
+    expires: int
+
+
+class Cache:
+    def __init__(self, path: str):
+        # autocommit, every finished download is kept even if the run crashes later
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS http_cache (
+                url TEXT PRIMARY KEY,
+                etag TEXT NOT NULL,
+                last_modified TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                image_name TEXT NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS host_profile (
+                host TEXT PRIMARY KEY,
+                profile INTEGER NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        # image key -> content addressed file it was stored as
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS addressed_image (
+                key TEXT PRIMARY KEY,
+                image_name TEXT NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS refresh_cache (
+                attachment TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                expires INTEGER NOT NULL,
+                updated REAL NOT NULL
+            )""")
+
+    def get_http(self, url: str) -> HttpEntry | None:
+        row = self._connection.execute(
+            "SELECT url, etag, last_modified, size, content_hash, image_name"
+            " FROM http_cache WHERE url = ?",
+            (url,),
+        ).fetchone()
+        return HttpEntry(*row) if row else None
+
+    def put_http(self, entry: HttpEntry) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry.url,
+                entry.etag,
+                entry.last_modified,
+                entry.size,
+                entry.content_hash,
+                entry.image_name,
+                time.time(),
+            ),
+        )
+
+    def get_addressed(self, key: str) -> str | None:
+        row = self._connection.execute(
+            "SELECT image_name FROM addressed_image WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_addressed(self, key: str, image_name: str) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO addressed_image VALUES (?, ?, ?)",
+            (key, image_name, time.time()),
+        )
+
+    def rename_image(self, image_name: str, new_name: str) -> None:
+        for table in ("http_cache", "addressed_image"):
+            self._connection.execute(
+                f"UPDATE {table} SET image_name = ? WHERE image_name = ?",
+                (new_name, image_name),
+            )
+
+    def get_refresh(self, attachment: str) -> RefreshEntry | None:
+        row = self._connection.execute(
+            "SELECT attachment, url, expires FROM refresh_cache WHERE attachment = ?",
+            (attachment,),
+        ).fetchone()
+        return RefreshEntry(*row) if row else None
+
+    def put_refresh(self, entry: RefreshEntry) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO refresh_cache VALUES (?, ?, ?, ?)",
+            (entry.attachment, entry.url, entry.expires, time.time()),
+        )
+
+    def get_profile(self, host: str) -> int | None:
+        row = self._connection.execute(
+            "SELECT profile FROM host_profile WHERE host = ?", (host,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_profile(self, host: str, profile: int) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO host_profile VALUES (?, ?, ?)",
+            (host, profile, time.time()),
+        )
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+_caches: dict[str, Cache] = {}
+
+
+def get_cache(config: Config) -> Cache:
+    if config.CACHE_PATH not in _caches:
+        _caches[config.CACHE_PATH] = Cache(config.CACHE_PATH)
+    return _caches[config.CACHE_PATH]
+
+
+def close_caches() -> None:
+    for cache in _caches.values():
+        cache.close()
+    _caches.clear()
+
+
+def get_conditional_headers(entry: HttpEntry | None) -> dict[str, str]:
+    headers = {}
+    if entry and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry and entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    return headers
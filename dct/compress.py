@@ -0,0 +1,153 @@
+import gzip
+import io
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO
+import brotlicffi
+import zstandard
+from dct.config import Config
+
+# extension of every precompressed copy of the output, in the order they are written
+COMPRESS_FORMATS = ("br", "gz", "zst")
+# data handed to a compressor thread at once, small writes are gathered until then
+COMPRESS_CHUNK_SIZE = 1 << 20
+# the output is handed to the OS in large blocks instead of 8 KiB ones
+WRITE_BUFFER_SIZE = 1 << 24
+
+
+def get_compress_formats(config: Config) -> list[str]:
+    formats = [
+        compress_format.strip().lower().lstrip(".")
+        for compress_format in config.COMPRESS_OUTPUT.split(",")
+    ]
+    return list(dict.fromkeys(filter(None, formats)))
+
+
+class BrotliFile:
+    def __init__(self, file: BinaryIO, quality: int):
+        self._file = file
+        self._compressor = brotlicffi.Compressor(quality=quality)
+
+    def write(self, data: bytes) -> None:
+        self._file.write(self._compressor.process(data))
+
+    def close(self) -> None:
+        self._file.write(self._compressor.finish())
+        self._file.close()
+
+
+class GzipFile:
+    def __init__(self, file: BinaryIO, level: int):
+        self._file = file
+        # no file name or time in the header, the same output compresses the same
+        self._compressor = gzip.GzipFile(
+            filename="", mode="wb", compresslevel=level, fileobj=file, mtime=0
+        )
+
+    def write(self, data: bytes) -> None:
+        self._compressor.write(data)
+
+    def close(self) -> None:
+        # gzip leaves a file object it was given open
+        try:
+            self._compressor.close()
+        finally:
+            self._file.close()
+
+
+def open_compressed(path: str, compress_format: str, config: Config) -> BinaryIO:
+    file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+    if compress_format == "br":
+        return BrotliFile(file, config.BROTLI_LEVEL)
+    if compress_format == "gz":
+        return GzipFile(file, config.GZIP_LEVEL)
+    compressor = zstandard.ZstdCompressor(level=config.ZSTD_LEVEL)
+    return compressor.stream_writer(file, closefd=True)
+
+
+class CompressedCopy:
+    def __init__(self, path: str, compress_format: str, config: Config):
+        self._file = open_compressed(path, compress_format, config)
+        # the compressors release the GIL, each one runs next to the serialiser
+        self._executor = ThreadPoolExecutor(1)
+        self._pending: Future | None = None
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self._buffer += data
+        if len(self._buffer) >= COMPRESS_CHUNK_SIZE:
+            self._submit()
+
+    def _submit(self) -> None:
+        # one chunk in flight, memory stays bounded when compression is the slower side
+        if self._pending is not None:
+            self._pending.result()
+        self._pending = self._executor.submit(self._file.write, bytes(self._buffer))
+        self._buffer.clear()
+
+    def close(self) -> None:
+        try:
+            if self._buffer:
+                self._submit()
+            if self._pending is not None:
+                self._pending.result()
+            self._file.close()
+        finally:
+            self._executor.shutdown()
+
+
+class OutputFile(io.RawIOBase):
+    # the output json and its precompressed copies, written in one pass
+    def __init__(self, config: Config):
+        super().__init__()
+        self._file = None
+        self._copies = []
+        path = config.OUTPUT_PATH
+        formats = get_compress_formats(config)
+        for compress_format in COMPRESS_FORMATS:
+            if compress_format not in formats and os.path.isfile(
+                f"{path}.{compress_format}"
+            ):
+                # a copy left by an earlier run would no longer match the output
+                os.remove(f"{path}.{compress_format}")
+        self._file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        try:
+            for compress_format in formats:
+                self._copies.append(
+                    CompressedCopy(f"{path}.{compress_format}", compress_format, config)
+                )
+        except BaseException:
+            self.close()
+            raise
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self._file.write(data)
+        if self._copies:
+            view = memoryview(data)
+            for start in range(0, len(view), COMPRESS_CHUNK_SIZE):
+                chunk = view[start : start + COMPRESS_CHUNK_SIZE]
+                for compressed in self._copies:
+                    compressed.write(chunk)
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        error = None
+        for compressed in self._copies:
+            try:
+                compressed.close()
+            except Exception as e:
+                error = error or e
+        if self._file is not None:
+            self._file.close()
+        super().close()
+        if error is not None:
+            raise error
+
+
+def open_output(config: Config) -> OutputFile:
+    return OutputFile(config)
@@ -16,26 +16,61 @@ class Config:
     UPDATE_PREFIXES: bool = False
     DOWNLOAD_IMAGES: bool = False
     RATE_LIMIT: int = 2
+    DISCORD_BATCH_SIZE: int = 50
+    REFRESH_MARGIN: int = 3600
+    CONNECTION_LIMIT: int = 32
+    CONNECTION_LIMIT_PER_HOST: int = 8
+    DNS_CACHE_TTL: int = 300
+    KEEPALIVE_TIMEOUT: int = 30
+    CONNECT_TIMEOUT: int = 30
     IMAGE_FOLDER: str = "images"
     IMAGE_QUALITY: int = 90
     OVERWRITE_IMAGES: bool = False
     PROJECT_FILE: str = "project.json"
     OUTPUT_FILE: str = "project_new.json"
     MINIFY: bool = False
+    SORT_KEYS: bool = True
+    COMPRESS_OUTPUT: str = ""
+    BROTLI_LEVEL: int = 9
+    GZIP_LEVEL: int = 9
+    ZSTD_LEVEL: int = 12
     DISABLE_IMAGES: bool = False
     DOWNLOAD_RATE_LIMIT: int = 5
     IMAGE_FORMAT: str = "WEBP"
     CONVERT_IMAGES: bool = False
+    OPTIMIZE_IMAGES: bool = False
+    OPTIMIZE_FORMATS: str = "WEBP,AVIF,PNG,JPEG"
+    MIN_PSNR: float = 40.0
+    MAX_WIDTH: int = 0
+    MAX_HEIGHT: int = 0
+    STRIP_METADATA: bool = False
+    CONVERT_ANIMATIONS: bool = False
+    ANIMATED_FORMAT: str = "WEBP"
     IMAGE_TO_BASE64: bool = False
     SHOW_CONFIG: bool = False
     PROJECT_URL: str = ""
     SESSION_TIMEOUT: int = 600
     LOG_FILE: str = "dct_log"
+    STREAM_JSON: bool = False
+    WORKERS: int = 0
+    WORKER_MODE: str = "process"
+    CONTENT_ADDRESSED: bool = False
+    HASH_ALGORITHM: str = "md5"
+    HTTP_CACHE: bool = False
+    CACHE_FILE: str = "dct_cache"
+    MANIFEST_FILE: str = "dct_manifest"
+    METRICS: bool = False
+    METRICS_FILE: str = "dct_metrics"
+    PROMETHEUS_FILE: str = ""
+    RESUME: bool = False
 
     PROJECT_PATH: str = field(init=False)
     IMAGE_PATH: str = field(init=False)
     OUTPUT_PATH: str = field(init=False)
     LOGFILE_PATH: str = field(init=False)
+    CACHE_PATH: str = field(init=False)
+    MANIFEST_PATH: str = field(init=False)
+    METRICS_PATH: str = field(init=False)
     LOGGER: Logger = field(init=False)
 
     def __post_init__(self):
@@ -53,4 +88,19 @@ class Config:
             "LOGFILE_PATH",
             os.path.join(self.OUTPUT_DIRECTORY, f"{self.LOG_FILE}.txt"),
         )
+        object.__setattr__(
+            self,
+            "CACHE_PATH",
+            os.path.join(self.OUTPUT_DIRECTORY, f"{self.CACHE_FILE}.sqlite"),
+        )
+        object.__setattr__(
+            self,
+            "MANIFEST_PATH",
+            os.path.join(self.OUTPUT_DIRECTORY, f"{self.MANIFEST_FILE}.jsonl"),
+        )
+        object.__setattr__(
+            self,
+            "METRICS_PATH",
+            os.path.join(self.OUTPUT_DIRECTORY, f"{self.METRICS_FILE}.json"),
+        )
         object.__setattr__(self, "LOGGER", set_log(self.LOGFILE_PATH))
@@ -1,16 +1,156 @@
+import json
+import sys
+import time
+from contextvars import ContextVar
 from rich.console import Console, Group
-from rich.progress import Progress, BarColumn, TextColumn, SpinnerColumn, DownloadColumn
+from rich.progress import (
+    Progress,
+    BarColumn,
+    TextColumn,
+    SpinnerColumn,
+    DownloadColumn,
+    Task,
+    TaskID,
+)
 from rich.live import Live
 from rich.layout import Layout
 from rich.panel import Panel
 from rich.prompt import Prompt, IntPrompt
 
+# seconds between two progress events of the same task in headless mode
+PROGRESS_INTERVAL = 1.0
+
 console = Console()
 prompt = Prompt(console)
 int_prompt = IntPrompt(console)
 
+_headless = False
+# failure counter and name of the project a task belongs to, every project of a
+# batch runs in its own context
+_failures: ContextVar[list[int]] = ContextVar("failures")
+_project: ContextVar[str] = ContextVar("project", default="")
+_run_failures = [0]
+
+
+def set_headless(headless: bool) -> None:
+    global _headless
+    _headless = headless
+    # stdout only carries the json events, messages go to stderr
+    console.file = sys.stderr if headless else sys.stdout
+
+
+def is_headless() -> bool:
+    return _headless
+
+
+def start_project(name: str) -> None:
+    _failures.set([0])
+    _project.set(name)
+
+
+def emit_event(event: dict) -> None:
+    if _project.get():
+        event = {"project": _project.get(), **event}
+    sys.stdout.write(json.dumps(event) + "\n")
+    sys.stdout.flush()
+
+
+def get_task(progress: Progress, task_id: TaskID) -> Task:
+    return next(task for task in progress.tasks if task.id == task_id)
+
+
+def report_failures(progress: Progress, task_id: TaskID, count: int = 1) -> None:
+    if count <= 0:
+        return
+    _failures.get(_run_failures)[0] += count
+    errors = get_task(progress, task_id).fields.get("errors", 0) + count
+    progress.update(task_id, errors=errors)
+
+
+def get_failures() -> int:
+    return _failures.get(_run_failures)[0]
+
+
+class EventProgress(Progress):
+    # renders nothing, reports its tasks as throttled json lines instead
+    def __init__(self, aggregate: bool = False):
+        super().__init__(disable=True)
+        # per file download bars are summed up into a single byte counter
+        self._aggregate = aggregate
+        self._last_event = {}
+        self._bytes = 0
+        self._files = 0
+        self._done_files = 0
+
+    def add_task(self, description: str, *args, **kwargs) -> TaskID:
+        task_id = super().add_task(description, *args, **kwargs)
+        self._files += 1
+        self._emit(task_id, not self._aggregate)
+        return task_id
+
+    def update(self, task_id: TaskID, *args, **kwargs) -> None:
+        self._bytes += kwargs.get("advance") or 0
+        super().update(task_id, *args, **kwargs)
+        self._emit(task_id, kwargs.get("refresh", False))
+
+    def remove_task(self, task_id: TaskID) -> None:
+        self._done_files += 1
+        self._emit(task_id)
+        super().remove_task(task_id)
+
+    def refresh(self) -> None:
+        # called at the end of a stage, reports the latest state right away
+        if self._aggregate:
+            self._emit(None, True)
+        else:
+            for task_id in self.task_ids:
+                self._emit(task_id, True)
+
+    def _emit(self, task_id: TaskID | None, force: bool = False) -> None:
+        if self._aggregate:
+            stage = "Downloading"
+            completed, total, size = self._done_files, self._files, self._bytes
+            errors = 0
+        else:
+            task = get_task(self, task_id)
+            stage = task.description
+            completed, total, size = task.completed, task.total, 0
+            errors = task.fields.get("errors", 0)
+        event = {
+            "event": "progress",
+            "stage": stage,
+            "completed": completed,
+            "total": total,
+            "bytes": size,
+            "errors": errors,
+        }
+        last_time, last_event = self._last_event.get(stage, (0, None))
+        if event == last_event:
+            return
+        now = time.monotonic()
+        # the end of a stage is always reported, everything else at most once
+        # per interval
+        finished = not self._aggregate and total is not None and completed >= total
+        if not (force or finished) and now - last_time < PROGRESS_INTERVAL:
+            return
+        self._last_event[stage] = (now, event)
+        emit_event(event)
+
+
+class NullLive:
+    def __enter__(self) -> "NullLive":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
+
+    def update(self, renderable: Panel) -> None:
+        pass
+
 
 def create_progress_bar(style: int = 0) -> Progress:
+    if _headless:
+        return EventProgress(aggregate=style == 1)
     if style == 1:
         progress = Progress(
             SpinnerColumn(),
@@ -42,5 +182,7 @@ def create_panel_layout(renderable: Progress | Group, style: int = 0) -> Panel:
     return panel
 
 
-def create_live(panel: Panel) -> Live:
+def create_live(panel: Panel) -> Live | NullLive:
+    if _headless:
+        return NullLive()
     return Live(panel, vertical_overflow="visible")
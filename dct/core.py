@@ -1,7 +1,10 @@
 import os
+import sys
 import asyncio
+import contextvars
 import yaml
 import argparse
+from dataclasses import fields
 from dct.json import (
     read_json,
     write_json,
@@ -9,27 +12,138 @@ from dct.json import (
     get_urls,
     update_urls,
     disable_images,
+    index_images,
 )
-from dct.download import process_images, process_project_url
+from dct.download import process_images, process_project_url, share_downloads
 from dct.discord import process_discord
-from dct.console import console, prompt, int_prompt
+from dct.console import (
+    console,
+    prompt,
+    int_prompt,
+    set_headless,
+    emit_event,
+    get_failures,
+    start_project,
+)
 from dct.base64 import process_base64, image_to_base64
 from dct.config import Config
+from dct.index import ImageIndex
+from dct.stream import StreamIndex, index_stream, write_stream
 from dct.paths import get_config
-from dct.logging import set_log
+from dct.pool import shutdown_pool
+from dct.cache import close_caches
+from dct.manifest import close_manifests
+from dct.session import shared_session, stats as connection_stats
+from dct.hash import KEY_ALGORITHMS, set_hash_algorithm
+from dct.metrics import measure, start_metrics, write_metrics
+from dct.compress import COMPRESS_FORMATS, get_compress_formats
 
+EXIT_OK = 0
+EXIT_ERROR = 1
+# the run finished but some images could not be refreshed, downloaded or converted
+EXIT_PARTIAL = 2
 
-async def main():
-    # current working directory
-    CWD = os.getcwd()
-    # parse argument
+
+def write_output(config: Config, index: ImageIndex) -> None:
+    with measure("write") as stage:
+        if isinstance(index, StreamIndex):
+            write_stream(config, index)
+        else:
+            write_json(config, index.data)
+        stage.items += len(index)
+        stage.bytes_out += os.path.getsize(config.OUTPUT_PATH)
+
+
+def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Image Processor for ICC JSONS")
     parser.add_argument(
         "--config", type=str, default="", help="Path to the configuration YAML file"
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip images already finished by the previous run of this config",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="No live panels or prompts, progress is printed as json lines",
+    )
+    parser.add_argument(
+        "--batch",
+        nargs="+",
+        default=[],
+        metavar="PATH",
+        help="Run several YAML files (or every YAML file in a directory) together",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of batch projects processed at the same time",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=0,
+        help="Number of open connections shared by all batch projects "
+        "(default: CONNECTION_LIMIT of the first project)",
+    )
+    return parser.parse_args()
+
+
+def load_config(yaml_path: str, resume: bool) -> Config | None:
+    # validate yaml
+    if (
+        not os.path.isfile(yaml_path)
+        or os.path.splitext(yaml_path)[-1].lower() != ".yaml"
+    ):
+        console.print(f"[bold red]ERROR: {yaml_path} is not a valid YAML file")
+        return None
+    # read yaml
+    with open(yaml_path, "r") as yaml_file:
+        try:
+            yaml_config = yaml.safe_load(yaml_file)
+        except yaml.YAMLError as e:
+            console.print(f"[bold red]ERROR: {yaml_path} is not a valid YAML file: {e}")
+            return None
+
+    console.print(f"[blue]Reading {yaml_path}...")
+
+    # an empty file loads as None
+    if not isinstance(yaml_config, dict):
+        console.print(f"[bold red]ERROR: {yaml_path} has no configuration parameters")
+        return None
+    parameters = {field.name for field in fields(Config) if field.init}
+    unknown_parameters = [key for key in yaml_config if key not in parameters]
+    if unknown_parameters:
+        console.print(
+            f"[bold red]ERROR: unknown parameters in {yaml_path}: {', '.join(map(str, unknown_parameters))}"
+        )
+        return None
+    if resume:
+        yaml_config["RESUME"] = True
+    # the streamed output is the input with its image values replaced, keys stay
+    # in their input order
+    if yaml_config.get("STREAM_JSON") and yaml_config.get("SORT_KEYS"):
+        console.print(
+            f"[bold yellow]WARNING: SORT_KEYS is ignored with STREAM_JSON in {yaml_path}, keys keep the order of the input"
+        )
+
+    return Config(**yaml_config)
+
+
+async def main(args: argparse.Namespace | None = None) -> int:
+    # current working directory
+    CWD = os.getcwd()
+    # parse argument
+    if args is None:
+        args = parse_args()
     # set yaml path
     yaml_path = args.config
+    if not yaml_path and args.headless:
+        console.print("[bold red]ERROR: --config is required in headless mode")
+        return EXIT_ERROR
     if not yaml_path:
         console.print(
             "[bold red]Config parameter not provided, switching to manual selection mode..."
@@ -49,20 +163,94 @@ async def main():
             default=1,
         )
         yaml_path = os.path.join(config_directory, yaml_files[index - 1])
-    # validate yaml
-    if (
-        not os.path.isfile(yaml_path)
-        or os.path.splitext(yaml_path)[-1].lower() != ".yaml"
-    ):
-        console.print(f"[bold red]ERROR: {yaml_path} is not a valid YAML file")
-        return
-    # read yaml
-    with open(yaml_path, "r") as yaml_file:
-        yaml_config = yaml.safe_load(yaml_file)
 
-    console.print(f"[blue]Reading {yaml_path}...")
+    config = load_config(yaml_path, args.resume)
+    if config is None:
+        return EXIT_ERROR
+    # one tuned session for every network stage of the run
+    async with shared_session(config):
+        exit_code = await run_project(config)
+    config.LOGGER.debug(connection_stats.summary())
+    return exit_code
+
+
+async def get_batch_configs(paths: list[str]) -> list[str]:
+    yaml_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            yaml_files = sorted(await get_config(path))
+            yaml_paths.extend(os.path.join(path, file) for file in yaml_files)
+        else:
+            yaml_paths.append(path)
+    return yaml_paths
 
-    config = Config(**yaml_config)
+
+def report_config_error(yaml_path: str) -> None:
+    # the project never started, its done event is all there is of it
+    start_project(yaml_path)
+    emit_event({"event": "done", "status": EXIT_ERROR, "errors": get_failures()})
+
+
+async def run_batch(args: argparse.Namespace) -> int:
+    yaml_paths = await get_batch_configs(args.batch)
+    configs = []
+    exit_codes = []
+    for yaml_path in yaml_paths:
+        # a broken config only fails its own project, the others still run
+        try:
+            config = load_config(yaml_path, args.resume)
+        except Exception as e:
+            console.print(f"[bold red]ERROR: {yaml_path} could not be loaded: {e}")
+            config = None
+        if config is None:
+            contextvars.copy_context().run(report_config_error, yaml_path)
+            exit_codes.append(EXIT_ERROR)
+        else:
+            configs.append(config)
+    semaphore = asyncio.Semaphore(max(1, args.jobs))
+
+    async def run_batch_project(config: Config) -> int:
+        async with semaphore:
+            # a task has its own context, failures are counted per project
+            start_project(config.PROJECT_URL or config.PROJECT_PATH)
+            try:
+                exit_code = await run_project(config)
+            except Exception as e:
+                console.print(
+                    f"[bold red]An unexpected error occurred in {config.PROJECT_FILE}: {e}"
+                )
+                exit_code = EXIT_ERROR
+            emit_event({"event": "done", "status": exit_code, "errors": get_failures()})
+            return exit_code
+
+    if not configs:
+        return EXIT_ERROR
+    # connection settings of the first project apply to the whole batch
+    async with shared_session(configs[0], args.connections):
+        with share_downloads():
+            exit_codes += await asyncio.gather(
+                *(run_batch_project(config) for config in configs)
+            )
+    configs[0].LOGGER.debug(connection_stats.summary())
+    # an error anywhere outranks images that failed
+    if EXIT_ERROR in exit_codes:
+        return EXIT_ERROR
+    return max(exit_codes, default=EXIT_OK)
+
+
+async def run_project(config: Config) -> int:
+    start_metrics(config.PROJECT_URL or config.PROJECT_PATH)
+    exit_code = EXIT_ERROR
+    try:
+        exit_code = await process_project(config)
+    finally:
+        # written even when the run stops early, to see how far it got
+        if config.METRICS:
+            write_metrics(config, exit_code)
+    return exit_code
+
+
+async def process_project(config: Config) -> int:
     # show config
     if config.SHOW_CONFIG:
         console.print(config)
@@ -74,17 +262,39 @@ async def main():
         console.print(
             "[bold red]PROJECT_FILE and OUTPUT_FILE are the same and are in the same directory. Please provide different names or directories. Exiting..."
         )
-        return
-    # handle project url
-    if config.PROJECT_URL.startswith("http"):
-        data = await process_project_url(config)
-    else:
-        console.print("[blue]Reading JSON Data...")
-        data = read_json(config.PROJECT_PATH)
+        return EXIT_ERROR
+    # image keys of this project, set before anything is indexed
+    if not set_hash_algorithm(config.HASH_ALGORITHM):
+        console.print(
+            f"[bold red]HASH_ALGORITHM : {config.HASH_ALGORITHM} is not supported, use one of {', '.join(KEY_ALGORITHMS)}"
+        )
+        return EXIT_ERROR
+    unknown_formats = set(get_compress_formats(config)) - set(COMPRESS_FORMATS)
+    if unknown_formats:
+        console.print(
+            f"[bold red]COMPRESS_OUTPUT : {', '.join(sorted(unknown_formats))} is not supported, use any of {', '.join(COMPRESS_FORMATS)}"
+        )
+        return EXIT_ERROR
+    with measure("read") as stage:
+        # handle project url
+        if config.PROJECT_URL.startswith("http"):
+            index = await process_project_url(config)
+        elif config.STREAM_JSON:
+            console.print("[blue]Scanning JSON Data...")
+            index = index_stream(config.PROJECT_PATH)
+        else:
+            console.print("[blue]Reading JSON Data...")
+            index = index_images(read_json(config.PROJECT_PATH))
+        stage.items += len(index)
+        # a downloaded project is counted as it arrives, PROJECT_PATH was not read
+        if not config.PROJECT_URL.startswith("http") and os.path.isfile(
+            config.PROJECT_PATH
+        ):
+            stage.bytes_in += os.path.getsize(config.PROJECT_PATH)
     # error when json data is empty
-    if not data:
+    if not index.data:
         console.print("[bold red]Error: empty JSON data")
-        return
+        return EXIT_ERROR
     # validate output file name and remove it if its json
     if (
         os.path.isfile(config.OUTPUT_PATH)
@@ -96,7 +306,7 @@ async def main():
         console.print(
             f"[bold red]ERROR: OUTPUT_FILE : {config.OUTPUT_FILE} is not a valid JSON file name"
         )
-        return
+        return EXIT_ERROR
     # disable images
     if config.DISABLE_IMAGES:
         console.print(
@@ -105,27 +315,30 @@ async def main():
         console.print(
             "[bold red]Ensure that you don't delete the original project file, as recovering images is impossible."
         )
-        data = disable_images(data)
-        write_json(config, data)
-        return
+        disable_images(index)
+        write_output(config, index)
+        return EXIT_OK
     # create image folder
     console.print("[blue]Checking/Creating Image Folder...")
     os.makedirs(config.IMAGE_PATH, exist_ok=True)
     # process discord url
     if config.PROCESS_DISCORD_LINKS:
         console.print("[blue]Processing Discord Links...")
-        data = await process_discord(data, config)
+        with measure("refresh"):
+            await process_discord(index, config)
     # base64 to images
     if config.BASE64_TO_IMAGE:
-        new_urls = await process_base64(data, config)
-        if new_urls:
-            data = await update_urls(data, new_urls)
+        with measure("base64"):
+            new_urls = await process_base64(index, config)
+            if new_urls:
+                update_urls(index, new_urls)
     # download images other than discord urls
     if config.DOWNLOAD_IMAGES:
-        urls = await get_urls(data)
+        urls = get_urls(index)
         if urls:
-            new_urls = await process_images(urls, config)
-            data = await update_urls(data, new_urls)
+            with measure("download"):
+                new_urls = await process_images(urls, config)
+                update_urls(index, new_urls)
         else:
             console.print("[bold red]No other URLs found, skipping")
     # images to base64
@@ -136,23 +349,36 @@ async def main():
             )
         else:
             console.print("[blue]Converting images to base64 embeds...")
-            base64_map = await image_to_base64(config)
-            data = await update_urls(data, base64_map)
-            write_json(config, data)
-            return
+            with measure("embed"):
+                await image_to_base64(index, config)
+            write_output(config, index)
+            return EXIT_PARTIAL if get_failures() else EXIT_OK
     # update prefixes
     if config.UPDATE_PREFIXES:
-        data = update_prefixes(data, config)
+        update_prefixes(index, config)
     # write output file
-    write_json(config, data)
+    write_output(config, index)
+    return EXIT_PARTIAL if get_failures() else EXIT_OK
 
 
 def run_main():
+    args = parse_args()
+    # several live panels cannot be shown at once, batches always run headless
+    set_headless(args.headless or bool(args.batch))
+    exit_code = EXIT_ERROR
     try:
-        asyncio.run(main())
+        exit_code = asyncio.run(run_batch(args) if args.batch else main(args))
     except Exception as e:
         console.print(f"[bold red]An unexpected error occurred: {e}")
-    input("Press any key to exit...")
+    finally:
+        shutdown_pool()
+        close_caches()
+        close_manifests()
+    if args.headless or args.batch:
+        emit_event({"event": "exit", "status": exit_code, "errors": get_failures()})
+    if not (args.headless or args.batch):
+        input("Press any key to exit...")
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
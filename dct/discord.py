@@ -1,122 +1,278 @@
 import asyncio
+import time
 import aiohttp
+from urllib.parse import urlparse, parse_qs
 from dct.json import get_urls, update_urls
-from dct.download import process_images
+from dct.index import ImageIndex
+from dct.download import Downloader
 from dct.console import (
     console,
     create_progress_bar,
+    create_group,
     create_panel_layout,
     create_live,
+    report_failures,
     Progress,
 )
 from dct.config import Config
-from dct.semaphore import DynamicSemaphore
+from dct.semaphore import RateLimiter
+from dct.session import open_session
+from dct.manifest import get_manifest, REFRESH_STAGE, DONE, FAILED
+from dct.cache import RefreshEntry, get_cache
+from dct.metrics import record
 
+REFRESH_URL = "https://discord.com/api/v9/attachments/refresh-urls"
+REFRESH_ROUTE = "POST /attachments/refresh-urls"
 
-async def refresh_url(session: aiohttp.ClientSession, url: str, config: Config) -> dict:
-    api_url = "https://discord.com/api/v9/attachments/refresh-urls"
-    payload = {"attachment_urls": [url]}
+
+def get_attachment(url: str) -> tuple[str, int]:
+    parsed_url = urlparse(url)
+    # attachments/<channel id>/<attachment id>/<file name>, same on every cdn host
+    attachment = "/".join(parsed_url.path.rsplit("/", 3)[-3:])
+    query = parse_qs(parsed_url.query)
+    # ex is the hex unix time the signature (is, hm) stops being accepted
+    if not all(param in query for param in ("ex", "is", "hm")):
+        return attachment, 0
+    try:
+        return attachment, int(query["ex"][0], 16)
+    except ValueError:
+        return attachment, 0
+
+
+def split_expired(urls: dict, config: Config) -> tuple[dict, dict]:
+    cache = get_cache(config)
+    deadline = time.time() + config.REFRESH_MARGIN
+    valid = {}
+    expired = {}
+    for key, url in urls.items():
+        attachment, expires = get_attachment(url)
+        entry = cache.get_refresh(attachment)
+        if entry and entry.expires > expires:
+            # refreshed by an earlier run and still newer than the project link
+            url, expires = entry.url, entry.expires
+        if expires > deadline:
+            valid[key] = url
+        else:
+            expired[key] = urls[key]
+    return valid, expired
+
+
+def is_fresh(url: str, config: Config) -> bool:
+    _, expires = get_attachment(url)
+    return expires > time.time() + config.REFRESH_MARGIN
+
+
+def remember_refresh(config: Config, url: str, new_url: str) -> None:
+    attachment, expires = get_attachment(new_url)
+    if expires:
+        get_cache(config).put_refresh(RefreshEntry(attachment, new_url, expires))
+
+
+def get_batches(urls: dict, batch_size: int) -> list[dict]:
+    items = list(urls.items())
+    batch_size = max(1, batch_size)
+    return [dict(items[i : i + batch_size]) for i in range(0, len(items), batch_size)]
+
+
+async def refresh_url(
+    session: aiohttp.ClientSession, urls: list[str], config: Config
+) -> dict:
+    payload = {"attachment_urls": urls}
     headers = {"Authorization": f"Bot {config.TOKEN}"}
 
     try:
-        async with session.post(api_url, json=payload, headers=headers) as response:
+        async with session.post(REFRESH_URL, json=payload, headers=headers) as response:
             if response.status == 200:
                 refreshed_urls = await response.json()
                 return {
                     "status": response.status,
-                    "new_url": refreshed_urls["refreshed_urls"][0]["refreshed"],
+                    "headers": response.headers,
+                    "new_urls": {
+                        item["original"]: item["refreshed"]
+                        for item in refreshed_urls["refreshed_urls"]
+                        if item.get("refreshed")
+                    },
                 }
-            elif response.status == 429:
-                return {"status": response.status, "headers": response.headers}
             else:
-                return {"status": response.status}
+                return {"status": response.status, "headers": response.headers}
     except (aiohttp.ClientError, Exception) as e:
         return {"status": "error", "error": str(e)}
 
 
 async def try_refresh(
     session: aiohttp.ClientSession,
-    url: str,
-    key: str,
+    batch: dict,
     config: Config,
-    semaphore: DynamicSemaphore,
-) -> tuple[dict, bool]:
+    limiter: RateLimiter,
+) -> tuple[dict, int]:
     max_retries = 5
     retries = 1
-    exp_limit = semaphore._max_count
-    exp_time = 1
-    new_limit = exp_limit
+    manifest = get_manifest(config)
+    # refreshed urls come back keyed by the original url, not by position
+    pending = dict(batch)
+    results = {}
 
-    while retries <= max_retries:
-        async with semaphore:
-            status_info = await refresh_url(session, url, config)
+    while retries <= max_retries and pending:
+        # waits for the discord bucket before sending instead of after a 429
+        async with limiter.request(REFRESH_ROUTE):
+            status_info = await refresh_url(
+                session, list(dict.fromkeys(pending.values())), config
+            )
             status = status_info["status"]
+            limiter.update(REFRESH_ROUTE, status, status_info.get("headers", {}))
+            record("refresh", status=status, retries=int(retries > 1))
 
             if status == 200:
-                return {key: status_info["new_url"]}, True
+                new_urls = status_info["new_urls"]
+                for key, url in list(pending.items()):
+                    if url in new_urls:
+                        results[key] = new_urls[url]
+                        remember_refresh(config, url, new_urls[url])
+                        manifest.record(
+                            REFRESH_STAGE, key, url, DONE, retries - 1, new_urls[url]
+                        )
+                        del pending[key]
+                if pending:
+                    # only the members missing from the response are sent again
+                    config.LOGGER.debug(
+                        f"{len(pending)} of {len(batch)} urls not refreshed, retrying..."
+                    )
             elif status == 429:
-                headers = status_info["headers"]
-                exp_limit = max(1, exp_limit // retries)
-                exp_time = min(60, exp_time * retries)
-                reset_after = float(headers.get("X-RateLimit-Reset-After", exp_time))
-                new_limit = int(headers.get("X-RateLimit-Limit", exp_limit))
-                await semaphore.update_max_count(new_limit)
+                retry_after = status_info["headers"].get("Retry-After", "?")
                 config.LOGGER.debug(
-                    f"Rate limited for {key}, sleeping for {reset_after} seconds..."
+                    f"Rate limited for batch of {len(pending)} urls, retrying after {retry_after} seconds..."
                 )
-                await asyncio.sleep(reset_after)
             else:
                 error = status if status != "error" else status_info["error"]
-                config.LOGGER.debug(
-                    f"Failed to refresh url for {key} with status: {error}, url: {url}"
-                )
-                return {key: url}, False
+                for key, url in pending.items():
+                    config.LOGGER.debug(
+                        f"Failed to refresh url for {key} with status: {error}, url: {url}"
+                    )
+                    manifest.record(REFRESH_STAGE, key, url, FAILED, retries - 1, url)
+                return results | pending, len(results)
 
         retries += 1
 
-    config.LOGGER.debug(f"Max retries exceeded for {key}, url: {url}")
-    return {key: url}, False
+    for key, url in pending.items():
+        config.LOGGER.debug(f"Max retries exceeded for {key}, url: {url}")
+        manifest.record(REFRESH_STAGE, key, url, FAILED, max_retries, url)
+    return results | pending, len(results)
+
+
+async def refresh_urls(
+    session: aiohttp.ClientSession,
+    urls: dict,
+    config: Config,
+    progress: Progress,
+    downloader: Downloader | None = None,
+) -> dict:
+    manifest = get_manifest(config)
+    # a refreshed link from an earlier run may have expired since
+    finished, pending = manifest.split(
+        REFRESH_STAGE, urls, lambda url: is_fresh(url, config)
+    )
+    if finished:
+        console.print(f"[blue]Resuming, {len(finished)} urls already refreshed")
+    # links that stay valid past the safety margin are not sent to discord
+    valid, pending = split_expired(pending, config)
+    for key, url in valid.items():
+        manifest.record(REFRESH_STAGE, key, urls[key], DONE, output=url)
+    if valid:
+        console.print(f"[blue]{len(valid)} urls are still valid, skipping refresh")
+    finished |= valid
+
+    limiter = RateLimiter(config.RATE_LIMIT, "refresh")
+    task = progress.add_task(
+        "Refreshing URLs", total=len(urls), completed=len(finished)
+    )
+    # started before the already known urls are queued so both stages begin at once,
+    # as_completed alone would only schedule them once it is first iterated
+    tasks = [
+        asyncio.create_task(try_refresh(session, batch, config, limiter))
+        for batch in get_batches(pending, config.DISCORD_BATCH_SIZE)
+    ]
+    refreshing = asyncio.as_completed(tasks)
+    if downloader is not None:
+        await downloader.submit(finished)
+    results = [finished]
+    for coro in refreshing:
+        result, refreshed = await coro
+        results.append(result)
+        record("refresh", items=refreshed)
+        progress.update(task, advance=refreshed)
+        report_failures(progress, task, len(result) - refreshed)
+        # every finished batch goes straight to the downloads, the other batches
+        # keep refreshing in the meantime
+        if downloader is not None:
+            await downloader.submit(result)
+
+    config.LOGGER.debug(
+        f"Refresh requests: {limiter.requests}, rate limited: {limiter.rate_limited}, "
+        f"delayed before the limit: {limiter.avoided}"
+    )
+    return {k: v for r in results for k, v in r.items()}
 
 
 async def process_refresh(urls: dict, config: Config) -> dict:
-    semaphore = DynamicSemaphore(config.RATE_LIMIT)
     refresh_progress = create_progress_bar()
+    new_urls = {}
     try:
-        async with aiohttp.ClientSession() as session:
-            tasks = [
-                try_refresh(session, url, key, config, semaphore)
-                for key, url in urls.items()
-            ]
-            task = refresh_progress.add_task("Refreshing URLs", total=len(tasks))
+        async with open_session() as session:
             live_panel = create_live(create_panel_layout(refresh_progress, 1))
 
             with live_panel:
-                results = []
-                for coro in asyncio.as_completed(tasks):
-                    result, status = await coro
-                    results.append(result)
-                    if status:
-                        refresh_progress.update(task, advance=1)
+                new_urls = await refresh_urls(session, urls, config, refresh_progress)
+
+    except aiohttp.ClientError as e:
+        config.LOGGER.debug(f"Client error: {str(e)}")
+    except Exception as e:
+        config.LOGGER.debug(f"Unexpected error: {str(e)}")
+
+    return new_urls
+
+
+async def process_refresh_and_download(urls: dict, config: Config) -> dict:
+    image_progress = create_progress_bar()
+    download_progress = create_progress_bar(1)
+    image_panel_group = create_group(image_progress, download_progress)
+    timeout = aiohttp.ClientTimeout(total=config.SESSION_TIMEOUT)
+    try:
+        async with open_session() as refresh_session, open_session(
+            timeout=timeout
+        ) as session:
+            downloader = Downloader(
+                session, config, image_progress, download_progress, len(urls)
+            )
+            live_panel = create_live(create_panel_layout(image_panel_group, 0))
+
+            with live_panel:
+                await refresh_urls(
+                    refresh_session, urls, config, image_progress, downloader
+                )
+                new_urls = await downloader.close()
+                live_panel.update(create_panel_layout(image_panel_group, 1))
 
     except aiohttp.ClientError as e:
         config.LOGGER.debug(f"Client error: {str(e)}")
+        raise e
     except Exception as e:
         config.LOGGER.debug(f"Unexpected error: {str(e)}")
+        raise e
 
-    new_urls = {k: v for r in results for k, v in r.items()}
     return new_urls
 
 
-async def process_discord(data, config: Config):
-    urls = await get_urls(data, True)
+async def process_discord(index: ImageIndex, config: Config) -> ImageIndex:
+    urls = get_urls(index, True)
 
     if not urls:
         console.print("[bold red]No discord links found...")
-        return data
-
-    new_urls = await process_refresh(urls, config)
+        return index
 
     if config.DOWNLOAD_IMAGES:
-        new_urls = await process_images(new_urls, config)
+        # refreshed urls are downloaded while the remaining ones are still refreshing
+        new_urls = await process_refresh_and_download(urls, config)
+    else:
+        new_urls = await process_refresh(urls, config)
 
-    return await update_urls(data, new_urls)
+    return update_urls(index, new_urls)
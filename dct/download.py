@@ -1,15 +1,19 @@
 import aiohttp
 import asyncio
 import os
-import json
+import shutil
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from typing import Any
+from urllib.parse import urlparse
+from typing import Any, Awaitable, BinaryIO, Callable, Iterator
 from dct.console import (
     console,
     create_progress_bar,
     create_group,
     create_panel_layout,
     create_live,
+    report_failures,
     Progress,
 )
 from dct.config import Config
@@ -17,11 +21,25 @@ from dct.paths import (
     get_image_name,
     get_url_components,
     get_parsed_url,
+    local_image_exists,
     ParseResult,
 )
-from dct.image import save_images
-from dct.json import update_urls, get_remote_urls
+from dct.image import Transcoder, find_image, get_optimize_formats, matches_image
+from dct.hash import new_hash
+from dct.cache import HttpEntry, get_cache, get_conditional_headers
+from dct.manifest import get_manifest, DOWNLOAD_STAGE, DONE, FAILED
+from dct.json import update_urls, get_remote_urls, index_images, loads
+from dct.index import ImageIndex
+from dct.stream import index_stream
 from dct.semaphore import DynamicSemaphore
+from dct.session import open_session
+from dct.metrics import record, record_sleep
+
+CHUNK_SIZE = 1 << 18
+# request profiles: the three browser header variants of get_headers, then none
+NO_HEADERS = 3
+PROFILES = (0, 1, 2, NO_HEADERS)
+MAX_RESUMES = 3
 
 
 async def get_headers(parsed_url: ParseResult, mode: int = 0) -> dict[str, str]:
@@ -47,103 +65,418 @@ async def get_headers(parsed_url: ParseResult, mode: int = 0) -> dict[str, str]:
     return headers
 
 
+class PartFile:
+    # temp file a download is streamed into, hashed while it is written. A part
+    # left by an earlier run is continued when its validator was kept with it
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 0
+        self.validator = ""
+        self._hash = new_hash()
+        self._validator_path = f"{path}.validator"
+        if os.path.exists(path) and os.path.exists(self._validator_path):
+            with open(self._validator_path, "r", encoding="utf-8") as f:
+                self.validator = f.read()
+            self._file = open(path, "r+b")
+            while chunk := self._file.read(CHUNK_SIZE):
+                self._hash.update(chunk)
+                self.size += len(chunk)
+        else:
+            self._file = open(path, "wb")
+            self._remove_validator()
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def keep(self, validator: str) -> None:
+        # written before any byte, a killed run leaves the part resumable
+        self.validator = validator
+        with open(self._validator_path, "w", encoding="utf-8") as f:
+            f.write(validator)
+
+    def restart(self) -> None:
+        self._file.seek(0)
+        self._file.truncate()
+        self._hash = new_hash()
+        self.size = 0
+        self.validator = ""
+        self._remove_validator()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    async def commit(self) -> str:
+        # on disk before anyone renames it into place
+        self._file.flush()
+        await asyncio.to_thread(os.fsync, self._file.fileno())
+        self._file.close()
+        self._remove_validator()
+        path, self.path = self.path, ""
+        return path
+
+    def discard(self) -> None:
+        self._file.close()
+        if self.size and self.validator:
+            # the next run asks only for the missing bytes
+            return
+        self._remove_validator()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _remove_validator(self) -> None:
+        if os.path.exists(self._validator_path):
+            os.remove(self._validator_path)
+
+
 async def download_content(
     response: aiohttp.ClientResponse,
     download_progress: Progress,
     file_name: str,
     remove_task: bool = False,
+    sink: BinaryIO | PartFile | None = None,
 ) -> bytearray:
     total_size = int(response.headers.get("content-length", 0))
     task_id = download_progress.add_task(
         "Downloading", total=total_size or None, filename=file_name
     )
     data = bytearray()
-    chunk_size = 1024
-    async for chunk in response.content.iter_chunked(chunk_size):
-        data.extend(chunk)
-        download_progress.update(task_id, advance=len(chunk))
-    if remove_task:
-        download_progress.remove_task(task_id)
+    try:
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            if sink is None:
+                data.extend(chunk)
+            else:
+                sink.write(chunk)
+            download_progress.update(task_id, advance=len(chunk))
+    finally:
+        if remove_task:
+            download_progress.remove_task(task_id)
     return data
 
 
-async def session_with_headers(
+def get_validator(response: aiohttp.ClientResponse) -> str:
+    etag = response.headers.get("ETag", "")
+    # If-Range only accepts a strong etag
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified", "")
+
+
+def starts_at(response: aiohttp.ClientResponse, offset: int) -> bool:
+    # Content-Range: bytes <first>-<last>/<length>
+    unit, _, byte_range = response.headers.get("Content-Range", "").partition(" ")
+    return unit == "bytes" and byte_range.split("-", 1)[0] == str(offset)
+
+
+async def download_rest(
     session: aiohttp.ClientSession,
     url: str,
+    headers: dict[str, str] | None,
     download_progress: Progress,
     file_name: str,
     remove_task: bool,
-) -> tuple[aiohttp.ClientResponse | str, bytearray]:
+    sink: PartFile,
+) -> aiohttp.ClientResponse | None:
+    # asks only for the bytes after those the part already holds, None when the
+    # server does not continue exactly there
+    range_headers = {**(headers or {}), "Range": f"bytes={sink.size}-"}
+    if sink.validator:
+        range_headers["If-Range"] = sink.validator
+    async with session.get(url, headers=range_headers) as response:
+        record("download", status=response.status)
+        if response.status == 200:
+            # range ignored or the file changed upstream, this is the whole file
+            sink.restart()
+        elif response.status != 206 or not starts_at(response, sink.size):
+            return None
+        await download_content(
+            response, download_progress, file_name, remove_task, sink
+        )
+    return response
 
-    retries = 0
-    parsed_url = await get_parsed_url(url)
 
-    while retries < 3:
-        headers = await get_headers(parsed_url, retries)
+async def read_content(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: dict[str, str] | None,
+    response: aiohttp.ClientResponse,
+    download_progress: Progress,
+    file_name: str,
+    remove_task: bool,
+    sink: BinaryIO | PartFile | None,
+) -> bytearray:
+    if isinstance(sink, PartFile):
+        sink.restart()
+        validator = get_validator(response)
+        if validator and response.headers.get("Accept-Ranges", "").lower() == "bytes":
+            sink.keep(validator)
+    try:
+        return await download_content(
+            response, download_progress, file_name, remove_task, sink
+        )
+    except aiohttp.ClientPayloadError:
+        if (
+            not isinstance(sink, PartFile)
+            or response.headers.get("Accept-Ranges", "").lower() != "bytes"
+        ):
+            raise
+    # the connection dropped mid transfer, ask only for the missing bytes
+    for _ in range(MAX_RESUMES):
+        try:
+            resumed = await download_rest(
+                session, url, headers, download_progress, file_name, remove_task, sink
+            )
+        except aiohttp.ClientPayloadError:
+            continue
+        if resumed is None:
+            break
+        return bytearray()
+    raise aiohttp.ClientPayloadError(f"Download of {file_name} could not be resumed")
+
+
+class RequestProfiles:
+    def __init__(self, config: Config):
+        self.config = config
+        # host -> profile that worked last, loaded from the cache on first use
+        self._hosts = {}
+        self.first_try = 0
+        self.fallbacks = 0
+        self.extra_requests = 0
+
+    def order(self, host: str) -> list[int]:
+        if host not in self._hosts:
+            self._hosts[host] = get_cache(self.config).get_profile(host)
+        learned = self._hosts[host]
+        if learned is None:
+            return list(PROFILES)
+        return [learned] + [profile for profile in PROFILES if profile != learned]
+
+    def learn(self, host: str, profile: int, attempt: int) -> None:
+        if attempt == 0:
+            self.first_try += 1
+        else:
+            self.fallbacks += 1
+            self.extra_requests += attempt
+        if self._hosts.get(host) != profile:
+            self._hosts[host] = profile
+            get_cache(self.config).put_profile(host, profile)
 
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await download_content(
-                    response, download_progress, file_name, remove_task
-                )
-                return response, data
-            elif response.status == 429:
-                break
-        retries += 1
-    return response, bytearray()
+    def summary(self) -> str:
+        return (
+            f"Request profiles: {self.first_try} first try, {self.fallbacks} "
+            f"fallbacks costing {self.extra_requests} extra requests"
+        )
+
+
+_profiles: dict[str, RequestProfiles] = {}
 
 
-async def session_without_headers(
+def get_profiles(config: Config) -> RequestProfiles:
+    if config.CACHE_PATH not in _profiles:
+        _profiles[config.CACHE_PATH] = RequestProfiles(config)
+    return _profiles[config.CACHE_PATH]
+
+
+async def get_profile_headers(parsed_url: ParseResult, profile: int) -> dict[str, str]:
+    if profile == NO_HEADERS:
+        return {}
+    return await get_headers(parsed_url, profile)
+
+
+async def session_with_profiles(
     session: aiohttp.ClientSession,
     url: str,
     download_progress: Progress,
     file_name: str,
     remove_task: bool,
-) -> tuple[aiohttp.ClientResponse, bytearray]:
-
-    async with session.get(url) as response:
-        if response.status == 200:
-            data = await download_content(
-                response, download_progress, file_name, remove_task
+    sink: BinaryIO | PartFile | None = None,
+    extra_headers: dict[str, str] | None = None,
+    profiles: RequestProfiles | None = None,
+    stage: str = "download",
+) -> tuple[aiohttp.ClientResponse | None, bytearray]:
+    response = None
+    parsed_url = await get_parsed_url(url)
+    host = parsed_url.netloc
+    # the profile that worked for this host before is tried first
+    order = profiles.order(host) if profiles else list(PROFILES)
+
+    if isinstance(sink, PartFile) and sink.size:
+        # a part kept by an earlier run, continued if the upstream file is the same
+        headers = await get_profile_headers(parsed_url, order[0])
+        try:
+            response = await download_rest(
+                session, url, headers, download_progress, file_name, remove_task, sink
             )
-            return response, data
+        except aiohttp.ClientPayloadError:
+            response = None
+        if response is not None:
+            return response, bytearray()
+        sink.restart()
+
+    for attempt, profile in enumerate(order):
+        headers = await get_profile_headers(parsed_url, profile)
+        headers.update(extra_headers or {})
 
+        async with session.get(url, headers=headers) as response:
+            record(stage, status=response.status)
+            if response.status in (200, 304):
+                if profiles:
+                    profiles.learn(host, profile, attempt)
+                if response.status == 304:
+                    return response, bytearray()
+                data = await read_content(
+                    session,
+                    url,
+                    headers,
+                    response,
+                    download_progress,
+                    file_name,
+                    remove_task,
+                    sink,
+                )
+                return response, data
+            elif response.status == 429:
+                break
     return response, bytearray()
 
 
-async def download_remote_project(config: Config) -> dict | Any:
+async def fetch_remote_project(
+    config: Config, sink: BinaryIO | None = None
+) -> bytearray | None:
     console.print(
         f"[bold blue]Downloading remote project json from url: {config.PROJECT_URL}"
     )
     _, file_name, _ = await get_url_components(config.PROJECT_URL)
     try:
-        async with aiohttp.ClientSession() as session:
+        async with open_session() as session:
             download_progress = create_progress_bar(1)
             live_panel = create_live(create_panel_layout(download_progress, 1))
             with live_panel:
-                response, data = await session_with_headers(
+                response, data = await session_with_profiles(
                     session,
                     config.PROJECT_URL,
                     download_progress,
                     file_name,
                     False,
+                    sink,
+                    stage="read",
                 )
-                if response and response.status != 200:
-                    response, data = await session_without_headers(
-                        session, config.PROJECT_URL, download_progress, file_name, False
+                if not response or response.status != 200:
+                    config.LOGGER.debug(
+                        "Failed to download project file: "
+                        f"{response.status if response else 'no response'}"
                     )
-                    if response and response.status != 200:
-                        config.LOGGER.debug(
-                            f"Failed to download project file: {response.status}"
-                        )
-                        return {}
+                    return None
+                record("read", bytes_in=sink.tell() if sink is not None else len(data))
     except aiohttp.ClientError as e:
         config.LOGGER.debug(f"[bold red]Client error: {str(e)}")
+        return None
     except Exception as e:
         config.LOGGER.debug(f"[bold red]Unexpected error: {str(e)}")
-        return {}
+        return None
+
+    return data
 
-    return json.loads(data.decode("utf-8")) if data else {}
+
+async def download_remote_project(config: Config) -> dict | Any:
+    data = await fetch_remote_project(config)
+    return loads(data) if data else {}
+
+
+async def stream_remote_project(config: Config) -> str:
+    _, file_name, _ = await get_url_components(config.PROJECT_URL)
+    file_path = os.path.join(config.OUTPUT_DIRECTORY, f"remote_{file_name}")
+    with open(file_path, "wb") as f:
+        data = await fetch_remote_project(config, f)
+    return file_path if data is not None else ""
+
+
+def get_image_file_name(key: str, config: Config, original_extension: str) -> str:
+    image_extension = (
+        config.IMAGE_FORMAT.lower() if config.CONVERT_IMAGES else original_extension
+    )
+    return f"image_{key}.{image_extension}"
+
+
+async def store_image(
+    response: aiohttp.ClientResponse,
+    part: PartFile,
+    url: str,
+    key: str,
+    original_extension: str,
+    config: Config,
+    transcoder: Transcoder,
+    entry: HttpEntry | None,
+) -> dict:
+    if response.status == 304:
+        return {
+            "status": 200,
+            "new_url": os.path.join(config.IMAGE_FOLDER, entry.image_name),
+        }
+
+    content_hash = part.hexdigest()
+    size = part.size
+    record("download", bytes_in=size)
+    # content addressed images are named by their bytes, so every url serving
+    # the same picture ends up on one file that is converted only once
+    file_key = content_hash if config.CONTENT_ADDRESSED else key
+    image_name = get_image_file_name(file_key, config, original_extension)
+    image_path = os.path.join(config.IMAGE_PATH, image_name)
+    # the upstream image changed since it was cached, replace the stale file
+    overwrite = entry is not None and entry.content_hash != content_hash
+    # the transcoder moves or converts the file and removes it afterwards
+    await transcoder.submit(
+        key, await part.commit(), image_path, original_extension, overwrite
+    )
+
+    if config.CONTENT_ADDRESSED:
+        get_cache(config).put_addressed(key, image_name)
+    if config.HTTP_CACHE:
+        get_cache(config).put_http(
+            HttpEntry(
+                url=url,
+                etag=response.headers.get("ETag", ""),
+                last_modified=response.headers.get("Last-Modified", ""),
+                size=size,
+                content_hash=content_hash,
+                image_name=image_name,
+            )
+        )
+    return {"status": 200, "new_url": os.path.join(config.IMAGE_FOLDER, image_name)}
+
+
+def get_cached_entry(
+    url: str, image_name: str, config: Config, original_extension: str
+) -> HttpEntry | None:
+    if not config.HTTP_CACHE or config.OVERWRITE_IMAGES:
+        return None
+    entry = get_cache(config).get_http(url)
+    # only revalidate when the cached file is still there in the current format
+    if (
+        entry
+        and os.path.exists(os.path.join(config.IMAGE_PATH, entry.image_name))
+        and matches_image(entry.image_name, image_name, config, original_extension)
+    ):
+        return entry
+    return None
+
+
+def get_addressed_name(
+    key: str, image_name: str, config: Config, original_extension: str
+) -> str | None:
+    # HTTP_CACHE revalidates the image instead, OVERWRITE_IMAGES downloads it again
+    if not config.CONTENT_ADDRESSED or config.HTTP_CACHE or config.OVERWRITE_IMAGES:
+        return None
+    addressed_name = get_cache(config).get_addressed(key)
+    # the content hash is only known after a download, an earlier run remembered it
+    if (
+        addressed_name
+        and os.path.exists(os.path.join(config.IMAGE_PATH, addressed_name))
+        and matches_image(addressed_name, image_name, config, original_extension)
+    ):
+        return addressed_name
+    return None
 
 
 async def download_image(
@@ -152,55 +485,77 @@ async def download_image(
     key: str,
     config: Config,
     download_progress: Progress,
+    transcoder: Transcoder,
 ) -> dict:
     status_info = None
+    part = None
     try:
         original_name = await get_image_name(url)
         original_extension = Path(original_name).suffix.split(".")[-1]
-        image_name = f"image_{key}.{config.IMAGE_FORMAT.lower() if config.CONVERT_IMAGES else original_extension}"
+        image_name = get_image_file_name(key, config, original_extension)
         image_path = os.path.join(config.IMAGE_PATH, image_name)
         parsed_url = await get_parsed_url(url)
+        entry = get_cached_entry(url, image_name, config, original_extension)
+        conditional_headers = get_conditional_headers(entry)
+        addressed_name = get_addressed_name(key, image_name, config, original_extension)
+        existing = find_image(image_path, config, original_extension)
         if "imgur" in parsed_url.netloc:
             status_info = {
                 "status": "error",
                 "error": "skipping, imgur url processing is in development",
             }
-        elif not os.path.exists(image_path) or config.OVERWRITE_IMAGES:
-            response, data = await session_with_headers(
-                session, url, download_progress, key, True
+        elif addressed_name:
+            url = os.path.join(config.IMAGE_FOLDER, addressed_name)
+            status_info = {"status": 200, "new_url": url}
+        elif (
+            config.CONTENT_ADDRESSED
+            or config.HTTP_CACHE
+            or existing is None
+            or config.OVERWRITE_IMAGES
+        ):
+            part = PartFile(os.path.join(config.IMAGE_PATH, f"image_{key}.part"))
+            response, _ = await session_with_profiles(
+                session,
+                url,
+                download_progress,
+                key,
+                True,
+                part,
+                conditional_headers,
+                get_profiles(config),
             )
-            if response and response.status == 200:
-                await save_images(data, image_path, config, original_extension)
-                url = os.path.join(config.IMAGE_FOLDER, image_name)
-                status_info = {"status": response.status, "new_url": url}
+            # 206 is a part kept by an earlier run that was completed
+            if response and response.status in (200, 206, 304):
+                status_info = await store_image(
+                    response,
+                    part,
+                    url,
+                    key,
+                    original_extension,
+                    config,
+                    transcoder,
+                    entry,
+                )
             elif response and response.status == 429:
                 status_info = {
                     "status": response.status,
                     "headers": response.headers,
                 }
+            elif response:
+                status_info = {"status": response.status}
             else:
-                response, data = await session_without_headers(
-                    session, url, download_progress, key, True
-                )
-                if response and response.status == 200:
-                    await save_images(data, image_path, config, original_extension)
-                    url = os.path.join(config.IMAGE_FOLDER, image_name)
-                    status_info = {"status": response.status, "new_url": url}
-                elif response and response.status == 429:
-                    status_info = {
-                        "status": response.status,
-                        "headers": response.headers,
-                    }
-                elif response:
-                    status_info = {"status": response.status}
-                else:
-                    status_info = {"status": "error", "error": "No response received"}
+                status_info = {"status": "error", "error": "No response received"}
         else:
+            url = os.path.join(config.IMAGE_FOLDER, os.path.basename(existing))
             status_info = {"status": 200, "new_url": url}
     except aiohttp.ClientError as e:
         status_info = {"status": "error", "error": f"Client error: {str(e)}"}
     except Exception as e:
         status_info = {"status": "error", "error": f"Unexpected error: {str(e)}"}
+    finally:
+        # left over when the download failed or was not handed to the transcoder
+        if part is not None:
+            part.discard()
     return status_info
 
 
@@ -211,6 +566,7 @@ async def try_download(
     config: Config,
     semaphore: DynamicSemaphore,
     progress: Progress,
+    transcoder: Transcoder,
 ) -> tuple[dict, dict]:
     max_retries = 5
     retries = 1
@@ -220,10 +576,17 @@ async def try_download(
 
     while retries <= max_retries:
         async with semaphore:
-            status_info = await download_image(session, url, key, config, progress)
+            status_info = await download_image(
+                session, url, key, config, progress, transcoder
+            )
             status = status_info["status"]
 
+            record("download", retries=int(retries > 1))
             if status == 200:
+                record("download", items=1)
+                get_manifest(config).record(
+                    DOWNLOAD_STAGE, key, url, DONE, retries - 1, status_info["new_url"]
+                )
                 return {key: status_info["new_url"]}, True
             elif status == 429:
                 headers = status_info["headers"]
@@ -235,41 +598,244 @@ async def try_download(
                 config.LOGGER.debug(
                     f"Rate limited for {key}, sleeping for {reset_after} seconds..."
                 )
+                record_sleep("download", reset_after)
                 await asyncio.sleep(reset_after)
             else:
                 error = status if status != "error" else status_info["error"]
                 config.LOGGER.debug(
                     f"Failed to download for {key} with status: {error}, url: {url}"
                 )
+                get_manifest(config).record(
+                    DOWNLOAD_STAGE, key, url, FAILED, retries - 1, url
+                )
                 return {key: url}, False
         retries += 1
 
     config.LOGGER.debug(f"Max retries exceeded for {key}, url: {url}")
+    get_manifest(config).record(DOWNLOAD_STAGE, key, url, FAILED, max_retries, url)
     return {key: url}, False
 
 
+def link_image(source: str, target: str, overwrite: bool) -> None:
+    if os.path.exists(target) and (not overwrite or os.path.samefile(source, target)):
+        return
+    temp_path = f"{target}.{os.getpid()}.link"
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        # other file system or no hard link support
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, target)
+
+
+class SharedDownloads:
+    def __init__(self):
+        # url key and output settings -> future of the file the first project wrote
+        self._files = {}
+
+    async def download(
+        self,
+        key: str,
+        url: str,
+        config: Config,
+        transcoder: Transcoder,
+        fetch: Callable[[], Awaitable[tuple[dict, bool]]],
+    ) -> tuple[dict, bool]:
+        share_key = (
+            key,
+            config.CONVERT_IMAGES,
+            config.IMAGE_FORMAT.lower(),
+            config.IMAGE_QUALITY,
+            config.CONTENT_ADDRESSED,
+            config.OPTIMIZE_IMAGES,
+            tuple(get_optimize_formats(config)),
+            config.MIN_PSNR,
+            config.MAX_WIDTH,
+            config.MAX_HEIGHT,
+            config.STRIP_METADATA,
+            config.CONVERT_ANIMATIONS,
+            config.ANIMATED_FORMAT.lower(),
+        )
+        if share_key in self._files:
+            source = await asyncio.shield(self._files[share_key])
+            if source:
+                image_name = os.path.basename(source)
+                link_image(
+                    source,
+                    os.path.join(config.IMAGE_PATH, image_name),
+                    config.OVERWRITE_IMAGES,
+                )
+                new_url = os.path.join(config.IMAGE_FOLDER, image_name)
+                get_manifest(config).record(DOWNLOAD_STAGE, key, url, DONE, 0, new_url)
+                return {key: new_url}, True
+            # the other project could not save it, try on our own
+            return await fetch()
+
+        future = asyncio.get_running_loop().create_future()
+        self._files[share_key] = future
+        try:
+            result, status = await fetch()
+        except BaseException:
+            future.set_result(None)
+            raise
+        if not status:
+            future.set_result(None)
+        else:
+            image_path = os.path.join(config.OUTPUT_DIRECTORY, result[key])
+            # the file only exists once the transcoder wrote it, the download
+            # worker does not wait for that
+            asyncio.create_task(self._publish(future, transcoder, image_path))
+        return result, status
+
+    async def _publish(
+        self, future: asyncio.Future, transcoder: Transcoder, image_path: str
+    ) -> None:
+        try:
+            # animations may be written under another extension than queued
+            image_path = await transcoder.wait(image_path)
+        finally:
+            future.set_result(image_path if os.path.exists(image_path) else None)
+
+
+_shared_downloads: SharedDownloads | None = None
+
+
+def get_shared_downloads() -> SharedDownloads | None:
+    return _shared_downloads
+
+
+@contextmanager
+def share_downloads() -> Iterator[SharedDownloads]:
+    global _shared_downloads
+    _shared_downloads = SharedDownloads()
+    try:
+        yield _shared_downloads
+    finally:
+        _shared_downloads = None
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+class Downloader:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        config: Config,
+        image_progress: Progress,
+        download_progress: Progress,
+        total: int = 0,
+    ):
+        self.config = config
+        self.results = {}
+        self._urls = {}
+        self._resumed = 0
+        self._session = session
+        self._manifest = get_manifest(config)
+        self._semaphore = DynamicSemaphore(config.DOWNLOAD_RATE_LIMIT, "download")
+        # bounded so a fast producer (like the discord refresh) waits for downloads
+        self._queue = asyncio.Queue(maxsize=config.DOWNLOAD_RATE_LIMIT * 2)
+        self._image_progress = image_progress
+        self._download_progress = download_progress
+        self._task = image_progress.add_task("Downloading Images", total=total)
+        self._transcoder = Transcoder(config, image_progress)
+        self._workers = [
+            asyncio.create_task(self._work()) for _ in range(config.DOWNLOAD_RATE_LIMIT)
+        ]
+
+    async def submit(self, urls: dict) -> None:
+        self._urls |= urls
+        # images finished by an earlier run of this manifest are not fetched again
+        finished, pending = self._manifest.split(
+            DOWNLOAD_STAGE, urls, partial(local_image_exists, self.config)
+        )
+        self.results |= finished
+        self._resumed += len(finished)
+        self._image_progress.update(self._task, advance=len(finished))
+        # urls of one host are queued together so its connections stay warm
+        for key, url in sorted(pending.items(), key=lambda item: get_host(item[1])):
+            await self._queue.put((key, url))
+
+    async def _work(self) -> None:
+        while True:
+            key, url = await self._queue.get()
+            try:
+                fetch = partial(
+                    try_download,
+                    self._session,
+                    url,
+                    key,
+                    self.config,
+                    self._semaphore,
+                    self._download_progress,
+                    self._transcoder,
+                )
+                shared = get_shared_downloads()
+                if shared is None:
+                    result, status = await fetch()
+                else:
+                    # urls shared by several projects of a batch are fetched once
+                    result, status = await shared.download(
+                        key, url, self.config, self._transcoder, fetch
+                    )
+                self.results |= result
+                if status:
+                    self._image_progress.update(self._task, advance=1)
+                else:
+                    report_failures(self._image_progress, self._task)
+            except Exception as e:
+                self.config.LOGGER.debug(f"Unexpected error for {key}: {str(e)}")
+                self.results[key] = url
+                report_failures(self._image_progress, self._task)
+            finally:
+                self._queue.task_done()
+
+    async def close(self) -> dict:
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        failed = await self._transcoder.close()
+        self._download_progress.refresh()
+        # animations are named after the format they were written in, which was
+        # only known after their url had been handed out
+        for key, image_path in self._transcoder.renamed().items():
+            image_name = os.path.basename(self.results[key])
+            new_name = os.path.basename(image_path)
+            self.results[key] = os.path.join(self.config.IMAGE_FOLDER, new_name)
+            self._manifest.record(
+                DOWNLOAD_STAGE, key, self._urls[key], DONE, output=self.results[key]
+            )
+            if self.config.HTTP_CACHE or self.config.CONTENT_ADDRESSED:
+                get_cache(self.config).rename_image(image_name, new_name)
+        # images that could not be saved keep pointing at their original url
+        for key in failed:
+            self.results[key] = self._urls[key]
+            self._manifest.record(
+                DOWNLOAD_STAGE, key, self._urls[key], FAILED, output=self._urls[key]
+            )
+        self.config.LOGGER.debug(get_profiles(self.config).summary())
+        if self._resumed:
+            console.print(f"[blue]Resumed, {self._resumed} images already downloaded")
+        return self.results
+
+
 async def process_images(urls: dict, config: Config) -> dict:
-    semaphore = DynamicSemaphore(config.DOWNLOAD_RATE_LIMIT)
     image_progress = create_progress_bar()
     download_progress = create_progress_bar(1)
     image_panel_group = create_group(image_progress, download_progress)
     timeout = aiohttp.ClientTimeout(total=config.SESSION_TIMEOUT)
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            tasks = [
-                try_download(session, url, key, config, semaphore, download_progress)
-                for key, url in urls.items()
-            ]
-            task = image_progress.add_task("Downloading Images", total=len(tasks))
+        async with open_session(timeout=timeout) as session:
+            downloader = Downloader(
+                session, config, image_progress, download_progress, len(urls)
+            )
             live_panel = create_live(create_panel_layout(image_panel_group, 0))
 
             with live_panel:
-                results = []
-                for coro in asyncio.as_completed(tasks):
-                    result, status = await coro
-                    results.append(result)
-                    if status:
-                        image_progress.update(task, advance=1)
+                await downloader.submit(urls)
+                new_urls = await downloader.close()
                 live_panel.update(create_panel_layout(image_panel_group, 1))
 
     except aiohttp.ClientError as e:
@@ -279,20 +845,23 @@ async def process_images(urls: dict, config: Config) -> dict:
         config.LOGGER.debug(f"Unexpected error: {str(e)}")
         raise e
 
-    new_urls = {k: v for r in results for k, v in r.items()}
     return new_urls
 
 
-async def process_project_url(config: Config) -> Any:
-    data = await download_remote_project(config)
+async def process_project_url(config: Config) -> ImageIndex:
+    if config.STREAM_JSON:
+        file_path = await stream_remote_project(config)
+        index = index_stream(file_path) if file_path else index_images({})
+    else:
+        index = index_images(await download_remote_project(config))
 
-    if not data:
-        return {}
+    if not index.data:
+        return index
 
-    urls = await get_remote_urls(data, config)
+    urls = await get_remote_urls(index, config)
 
     if not urls:
         console.print("[bold red]No remote image folder found...")
-        return data
+        return index
 
-    return await update_urls(data, urls)
+    return update_urls(index, urls)
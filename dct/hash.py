@@ -1,7 +1,38 @@
 import hashlib
+from contextvars import ContextVar
 
+DEFAULT_ALGORITHM = "md5"
+# variable length digests cannot name files
+KEY_ALGORITHMS = sorted(
+    algorithm
+    for algorithm in hashlib.algorithms_guaranteed
+    if not algorithm.startswith("shake")
+)
 
-def hash_string(input_string: str, algorithm: str = "md5") -> str:
-    hash_obj = hashlib.new(algorithm)
+# algorithm of the image keys (and image names) of the running project, every
+# project of a batch runs in its own context
+_key_algorithm: ContextVar[str] = ContextVar("key_algorithm", default=DEFAULT_ALGORITHM)
+
+
+def set_hash_algorithm(algorithm: str) -> bool:
+    algorithm = algorithm.lower()
+    if algorithm not in KEY_ALGORITHMS:
+        return False
+    _key_algorithm.set(algorithm)
+    return True
+
+
+def hash_string(input_string: str, algorithm: str | None = None) -> str:
+    hash_obj = hashlib.new(algorithm or _key_algorithm.get())
     hash_obj.update(input_string.encode("utf-8"))
     return hash_obj.hexdigest()
+
+
+def hash_bytes(input_bytes: bytes, algorithm: str = "md5") -> str:
+    hash_obj = hashlib.new(algorithm)
+    hash_obj.update(input_bytes)
+    return hash_obj.hexdigest()
+
+
+def new_hash(algorithm: str = "md5") -> "hashlib._Hash":
+    return hashlib.new(algorithm)
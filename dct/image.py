@@ -1,33 +1,152 @@
+import asyncio
 import io
+import math
 import os
+import threading
+from contextlib import nullcontext
 import pillow_avif
-from PIL import Image
+from PIL import Image, ImageChops, ImageCms, ImageOps, ImageSequence, ImageStat
 from dct.config import Config
+from dct.console import Progress, report_failures
+from dct.pool import run_in_pool, get_workers
+from dct.metrics import busy, record
 
+HEADER_SIZE = 512
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+)
+# formats optimize_image can encode to, with the options that make them small
+OPTIMIZE_OPTIONS = {
+    "WEBP": {},
+    "AVIF": {"speed": 8},
+    "JPEG": {"optimize": True, "progressive": True},
+    "PNG": {},
+}
+LOSSY_FORMATS = {"WEBP", "AVIF", "JPEG"}
+# lowest quality tried by optimize_image and how many halvings it takes to get there
+MIN_QUALITY = 30
+QUALITY_STEPS = 3
+SRGB_PROFILE = ImageCms.createProfile("sRGB")
+ANIMATED_EXTENSIONS = {"GIF", "APNG"}
+ANIMATED_FORMATS = {"WEBP", "AVIF"}
+# formats an animation can end up in, re-encoded or kept as it was
+ANIMATION_EXTENSIONS = ("webp", "avif", "gif", "png")
+# browsers play gif frames with a delay of 10ms or less at 100ms
+GIF_MIN_DURATION = 10
+GIF_DEFAULT_DURATION = 100
 
-async def save_images(
-    image: bytearray, image_path: str, config: Config, original_extension: str
-) -> None:
-    if os.path.exists(image_path) and not config.OVERWRITE_IMAGES:
-        return
-
-    if os.path.exists(image_path):
-        os.remove(image_path)
 
+def needs_conversion(config: Config, original_extension: str) -> bool:
     original_format = original_extension.upper()
-    if config.CONVERT_IMAGES:
-        target_format = config.IMAGE_FORMAT.upper()
-        image_quality = config.IMAGE_QUALITY
-    else:
-        target_format = original_format
-        image_quality = 100
-
     if (
         config.CONVERT_IMAGES
-        and original_format != target_format
-        and original_format not in {"SVG", "GIF", "APNG", "WEBP", "AVIF"}
+        and config.CONVERT_ANIMATIONS
+        and original_format in ANIMATED_EXTENSIONS
     ):
-        image_data = Image.open(io.BytesIO(image))
+        return True
+    if config.CONVERT_IMAGES and config.OPTIMIZE_IMAGES:
+        # every raster image is resized and re-encoded
+        return original_format != "SVG"
+    return (
+        config.CONVERT_IMAGES
+        and original_format != config.IMAGE_FORMAT.upper()
+        and original_format not in {"SVG", "GIF", "APNG", "WEBP", "AVIF"}
+    )
+
+
+def may_be_animated(config: Config, original_extension: str) -> bool:
+    original_format = original_extension.upper()
+    if not (config.CONVERT_IMAGES and config.CONVERT_ANIMATIONS):
+        return False
+    if config.OPTIMIZE_IMAGES:
+        return original_format != "SVG"
+    return original_format in ANIMATED_EXTENSIONS or original_format == "PNG"
+
+
+def get_animation_path(image_path: str, image_format: str) -> str:
+    return f"{os.path.splitext(image_path)[0]}.{image_format.lower()}"
+
+
+def find_image(image_path: str, config: Config, original_extension: str) -> str | None:
+    if os.path.exists(image_path):
+        return image_path
+    # an animation is named after the format it was written in, which is only
+    # known after encoding
+    if may_be_animated(config, original_extension):
+        for extension in ANIMATION_EXTENSIONS:
+            path = get_animation_path(image_path, extension)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def matches_image(
+    name: str, image_name: str, config: Config, original_extension: str
+) -> bool:
+    # a file stored by an earlier run still fits the current image settings
+    extension = os.path.splitext(name)[1]
+    if extension == os.path.splitext(image_name)[1]:
+        return True
+    return may_be_animated(config, original_extension) and (
+        extension[1:] in ANIMATION_EXTENSIONS
+    )
+
+
+def write_image(
+    image: bytes | str,
+    image_path: str,
+    config: Config,
+    original_extension: str,
+    overwrite: bool = False,
+) -> str:
+    existing = find_image(image_path, config, original_extension)
+    if existing and not (overwrite or config.OVERWRITE_IMAGES):
+        return existing
+    if isinstance(image, str) and not needs_conversion(config, original_extension):
+        # a download that was streamed to disk already, moving it is enough
+        os.replace(image, image_path)
+        return image_path
+
+    # written next to the target and renamed into place, so concurrent writers of
+    # the same content addressed file never leave a half written image behind
+    temp_path = f"{image_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        image_format = encode_image(image, temp_path, config, original_extension)
+        written_path = (
+            get_animation_path(image_path, image_format) if image_format else image_path
+        )
+        os.replace(temp_path, written_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    if existing and existing != written_path:
+        # the earlier file of this image has another extension and is stale now
+        os.remove(existing)
+    return written_path
+
+
+def encode_image(
+    image: bytes | str, temp_path: str, config: Config, original_extension: str
+) -> str | None:
+    # only called by write_image, which renames the temp file into place. Returns
+    # the format of an animation, it is named after it instead of IMAGE_FORMAT
+    if config.OPTIMIZE_IMAGES and needs_conversion(config, original_extension):
+        return optimize_image(image, temp_path, config)
+    elif needs_conversion(config, original_extension):
+        target_format = config.IMAGE_FORMAT.upper()
+        image_quality = config.IMAGE_QUALITY
+        image_data = Image.open(image if isinstance(image, str) else io.BytesIO(image))
+        if config.CONVERT_ANIMATIONS and getattr(image_data, "is_animated", False):
+            animation, image_format = get_animation(
+                image_data, read_original(image), config
+            )
+            with open(temp_path, "wb") as f:
+                f.write(animation)
+            return image_format
         if image_data.mode in ("RGBA", "LA") or (
             image_data.mode == "P" and "transparency" in image_data.info
         ):
@@ -37,14 +156,374 @@ async def save_images(
             ).convert("RGB")
         else:
             image_data = image_data.convert("RGB")
-        image_data.save(image_path, format=target_format, quality=image_quality)
+        image_data.save(temp_path, format=target_format, quality=image_quality)
     else:
-        with open(image_path, "wb") as f:
+        with open(temp_path, "wb") as f:
             f.write(image)
+    return None
+
+
+def get_optimize_formats(config: Config) -> list[str]:
+    formats = [config.IMAGE_FORMAT] + config.OPTIMIZE_FORMATS.split(",")
+    formats = [image_format.strip().upper() for image_format in formats]
+    formats = [
+        "JPEG" if image_format == "JPG" else image_format for image_format in formats
+    ]
+    return [
+        image_format
+        for image_format in dict.fromkeys(formats)
+        if image_format in OPTIMIZE_OPTIONS
+    ]
+
+
+def has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (
+        image.mode == "P" and "transparency" in image.info
+    )
+
+
+def prepare_image(source: Image.Image, config: Config) -> tuple[Image.Image, bool]:
+    # orientation is applied to the pixels, the exif tag saying it may be dropped
+    image = ImageOps.exif_transpose(source)
+    icc_profile = source.info.get("icc_profile")
+    image = image.convert("RGBA" if has_alpha(image) else "RGB")
+    if config.STRIP_METADATA and icc_profile:
+        # without its profile the image is shown as srgb, so the pixels are made srgb
+        try:
+            image = ImageCms.profileToProfile(
+                image, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)), SRGB_PROFILE
+            )
+        except (ImageCms.PyCMSError, OSError):
+            pass
+    elif icc_profile:
+        image.info["icc_profile"] = icc_profile
+    resized = False
+    limit = (config.MAX_WIDTH or image.width, config.MAX_HEIGHT or image.height)
+    if image.width > limit[0] or image.height > limit[1]:
+        image.thumbnail(limit, Image.Resampling.LANCZOS)
+        resized = True
+    return image, resized
+
+
+def encode_candidate(
+    image: Image.Image, image_format: str, config: Config, exif: bytes, quality: int
+) -> bytes:
+    options = dict(OPTIMIZE_OPTIONS[image_format])
+    if image_format in LOSSY_FORMATS:
+        options["quality"] = quality
+    if not config.STRIP_METADATA:
+        options["exif"] = exif
+        options["icc_profile"] = image.info.get("icc_profile")
+    else:
+        # png would otherwise copy the profile from the image info
+        options["icc_profile"] = None
+    if image_format == "PNG":
+        colors = image.getcolors(256)
+        if colors is not None:
+            # few colours fit in a palette without losing any of them
+            image = image.quantize(len(colors), method=Image.Quantize.FASTOCTREE)
+            options["optimize"] = True
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def search_quality(
+    image: Image.Image, image_format: str, config: Config, exif: bytes
+) -> tuple[bytes | None, bytes]:
+    # smallest encoding that still meets MIN_PSNR, found by halving the quality
+    # range between MIN_QUALITY and IMAGE_QUALITY
+    high = config.IMAGE_QUALITY
+    top = encode_candidate(image, image_format, config, exif, high)
+    if get_psnr(image, top) < config.MIN_PSNR:
+        return None, top
+    best = top
+    if image_format not in LOSSY_FORMATS:
+        return best, top
+    low = min(MIN_QUALITY, high)
+    for _ in range(QUALITY_STEPS):
+        if high - low < 2:
+            break
+        quality = (low + high) // 2
+        encoded = encode_candidate(image, image_format, config, exif, quality)
+        if get_psnr(image, encoded) >= config.MIN_PSNR:
+            best = min(best, encoded, key=len)
+            high = quality
+        else:
+            low = quality
+    return best, top
+
+
+def get_psnr(reference: Image.Image, encoded: bytes) -> float:
+    with Image.open(io.BytesIO(encoded)) as decoded:
+        difference = ImageChops.difference(reference, decoded.convert(reference.mode))
+    mse = sum(rms**2 for rms in ImageStat.Stat(difference).rms) / len(reference.mode)
+    return math.inf if mse == 0 else 10 * math.log10(255**2 / mse)
+
+
+def get_animated_format(config: Config, loop: int) -> str:
+    image_format = config.ANIMATED_FORMAT.upper()
+    if image_format not in ANIMATED_FORMATS or (image_format == "AVIF" and loop):
+        # avif sequences always loop, animations that stop are written as webp
+        return "WEBP"
+    return image_format
+
+
+def get_frames(
+    source: Image.Image, limit: tuple[int, int] | None = None
+) -> tuple[list[Image.Image], list[int]]:
+    frames, durations = [], []
+    from_gif = source.format == "GIF"
+    for frame in ImageSequence.Iterator(source):
+        # every frame is read fully drawn, disposal and blending are already applied
+        duration = int(frame.info.get("duration") or 0)
+        if from_gif and duration <= GIF_MIN_DURATION:
+            duration = GIF_DEFAULT_DURATION
+        frame = frame.convert("RGBA")
+        if limit and (frame.width > limit[0] or frame.height > limit[1]):
+            frame.thumbnail(limit, Image.Resampling.LANCZOS)
+        if frames and not ImageChops.difference(frame, frames[-1]).getbbox(
+            alpha_only=False
+        ):
+            # a frame that changes nothing only extends the one before it
+            durations[-1] += duration
+            continue
+        frames.append(frame)
+        durations.append(duration)
+    return frames, durations
+
+
+def encode_animation(
+    source: Image.Image, config: Config, limit: tuple[int, int] | None = None
+) -> tuple[bytes, str]:
+    # gifs without a netscape loop block play once
+    loop = source.info.get("loop", 1)
+    image_format = get_animated_format(config, loop)
+    frames, durations = get_frames(source, limit)
+    options = {"quality": config.IMAGE_QUALITY}
+    if image_format == "WEBP":
+        # libwebp stores only the changed rectangle of each frame, allow_mixed
+        # lets it pick lossy or lossless per frame, whichever is smaller.
+        # minimize_size is left out, it can drop the alpha flag of the file
+        options.update(loop=loop, allow_mixed=True)
+    else:
+        options.update(OPTIMIZE_OPTIONS["AVIF"])
+    buffer = io.BytesIO()
+    frames[0].save(
+        buffer,
+        format=image_format,
+        save_all=True,
+        append_images=frames[1:],
+        duration=durations,
+        **options,
+    )
+    return buffer.getvalue(), image_format
+
+
+def get_animation(
+    source: Image.Image,
+    original: bytes,
+    config: Config,
+    limit: tuple[int, int] | None = None,
+) -> tuple[bytes, str]:
+    animation = encode_animation(source, config, limit)
+    resized = limit and (source.width > limit[0] or source.height > limit[1])
+    if not resized and len(original) <= len(animation[0]):
+        # small palette gifs can beat their re-encoding, they are kept as they are
+        return original, source.format
+    return animation
+
+
+def read_original(image: bytes | str) -> bytes:
+    if isinstance(image, str):
+        with open(image, "rb") as f:
+            return f.read()
+    return bytes(image)
+
+
+def optimize_image(image: bytes | str, temp_path: str, config: Config) -> str | None:
+    original = read_original(image)
+    # only animations are named after their format, stills keep IMAGE_FORMAT
+    image_format = None
+    with Image.open(io.BytesIO(original)) as source:
+        if getattr(source, "is_animated", False):
+            if config.CONVERT_ANIMATIONS:
+                limit = (
+                    config.MAX_WIDTH or source.width,
+                    config.MAX_HEIGHT or source.height,
+                )
+                animation, image_format = get_animation(source, original, config, limit)
+                candidates = [animation]
+            else:
+                candidates = [original]
+        else:
+            reference, resized = prepare_image(source, config)
+            exif = source.getexif()
+            if 0x0112 in exif:
+                del exif[0x0112]
+            exif = exif.tobytes() if exif else b""
+            # the original is a candidate too, unless it has to shrink or lose its
+            # metadata, it keeps the file name of IMAGE_FORMAT like skipped
+            # formats always did
+            candidates = [] if resized or config.STRIP_METADATA else [original]
+            fallback = None
+            for optimize_format in get_optimize_formats(config):
+                if optimize_format == "JPEG" and reference.mode == "RGBA":
+                    continue
+                best, top = search_quality(reference, optimize_format, config, exif)
+                fallback = fallback or top
+                if best is not None:
+                    candidates.append(best)
+            if not candidates:
+                # nothing is close enough, the first format tried (IMAGE_FORMAT
+                # unless it is jpeg and the image has alpha) at IMAGE_QUALITY
+                candidates = [fallback or original]
+    with open(temp_path, "wb") as f:
+        f.write(min(candidates, key=len))
+    return image_format
+
+
+async def save_images(
+    image: bytearray | str,
+    image_path: str,
+    config: Config,
+    original_extension: str,
+    overwrite: bool = False,
+) -> str:
+    existing = find_image(image_path, config, original_extension)
+    if existing and not (overwrite or config.OVERWRITE_IMAGES):
+        return existing
+    # encoding is cpu bound and goes to the worker pool, plain writes only need a thread
+    args = (image, image_path, config, original_extension, overwrite)
+    if needs_conversion(config, original_extension):
+        return await run_in_pool(config, write_image, *args)
+    return await asyncio.to_thread(write_image, *args)
+
+
+def remove_source(image: bytearray | str) -> None:
+    # downloads are handed over as temp files that belong to the transcoder
+    if isinstance(image, str) and os.path.exists(image):
+        os.remove(image)
+
+
+class Transcoder:
+    def __init__(self, config: Config, progress: Progress | None = None):
+        self.config = config
+        self.failed = {}
+        # image path -> keys of every url stored there
+        self._paths = {}
+        self._failed_paths = {}
+        # image path -> path the image was actually written to, animations are
+        # named after the format they ended up in
+        self._written_paths = {}
+        # image path -> future set to the written path once the image is saved
+        self._written = {}
+        workers = get_workers(config)
+        # bounded so downloads wait for the encoders instead of piling up in memory
+        self._queue = asyncio.Queue(maxsize=workers * 2)
+        self._progress = progress
+        self._task = None
+        self._submitted = 0
+        if progress is not None:
+            self._task = progress.add_task("Converting Images", total=0)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(workers)]
+
+    async def submit(
+        self,
+        key: str,
+        image: bytearray | str,
+        image_path: str,
+        original_extension: str,
+        overwrite: bool = False,
+    ) -> None:
+        if image_path in self._paths:
+            # same content already queued or converted in this run
+            self._paths[image_path].append(key)
+            if image_path in self._failed_paths:
+                self.failed[key] = self._failed_paths[image_path]
+            remove_source(image)
+            return
+        self._paths[image_path] = [key]
+        existing = find_image(image_path, self.config, original_extension)
+        if existing and not (overwrite or self.config.OVERWRITE_IMAGES):
+            self._written_paths[image_path] = existing
+            remove_source(image)
+            return
+        self._submitted += 1
+        if self._progress is not None:
+            self._progress.update(self._task, total=self._submitted)
+        self._written[image_path] = asyncio.get_running_loop().create_future()
+        await self._queue.put((key, image, image_path, original_extension, overwrite))
+
+    async def _work(self) -> None:
+        while True:
+            key, image, image_path, original_extension, overwrite = (
+                await self._queue.get()
+            )
+            converted = needs_conversion(self.config, original_extension)
+            written_path = image_path
+            try:
+                size = os.path.getsize(image) if isinstance(image, str) else len(image)
+                with busy("convert") if converted else nullcontext():
+                    written_path = await save_images(
+                        image, image_path, self.config, original_extension, overwrite
+                    )
+                self._written_paths[image_path] = written_path
+                if converted:
+                    record(
+                        "convert",
+                        items=1,
+                        bytes_in=size,
+                        bytes_out=os.path.getsize(written_path),
+                    )
+            except Exception as e:
+                self._failed_paths[image_path] = str(e)
+                for path_key in self._paths[image_path]:
+                    self.failed[path_key] = str(e)
+                self.config.LOGGER.debug(f"Failed to save image for {key}: {str(e)}")
+                if self._progress is not None:
+                    report_failures(self._progress, self._task)
+            finally:
+                remove_source(image)
+                self._written[image_path].set_result(written_path)
+                self._queue.task_done()
+                if self._progress is not None:
+                    self._progress.update(self._task, advance=1)
+
+    async def wait(self, image_path: str) -> str:
+        if image_path in self._written:
+            return await asyncio.shield(self._written[image_path])
+        return self._written_paths.get(image_path, image_path)
+
+    def renamed(self) -> dict[str, str]:
+        # key -> written path of every image saved under another name than queued
+        return {
+            key: written_path
+            for image_path, written_path in self._written_paths.items()
+            if written_path != image_path
+            for key in self._paths[image_path]
+        }
+
+    async def close(self) -> dict:
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self._progress is not None:
+            self._progress.update(self._task, refresh=True)
+        return self.failed
 
 
-async def open_images(image_path: str) -> tuple[io.BytesIO, str | None]:
+def get_image_format(header: bytes, image_path: str) -> str:
+    for signature, image_format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"avif", b"avis"):
+        return "avif"
+    if b"<svg" in header:
+        return "svg+xml"
+    # unknown signature, let PIL identify it (only the header is parsed)
     with Image.open(image_path) as image:
-        image_data = io.BytesIO()
-        image.save(image_data, format=image.format)
-    return image_data, image.format
+        return image.format.lower()
@@ -0,0 +1,70 @@
+from typing import Any, Iterator
+from dct.hash import hash_string
+
+DISCORD = "discord"
+REMOTE = "remote"
+BASE64 = "base64"
+LOCAL = "local"
+EMPTY = "empty"
+
+
+def classify_image(image: str) -> str:
+    if image.startswith("data:image"):
+        return BASE64
+    if image.startswith("http"):
+        return DISCORD if "discordapp" in image else REMOTE
+    if image:
+        return LOCAL
+    return EMPTY
+
+
+class ImageSlot:
+    __slots__ = ("parent", "key", "value", "kind", "_hash_key")
+
+    def __init__(self, parent: dict, key: str = "image"):
+        self.parent = parent
+        self.key = key
+        self._load()
+
+    def _load(self) -> None:
+        image = self.parent[self.key]
+        self.value = image.strip() if isinstance(image, str) else ""
+        self.kind = classify_image(self.value)
+        # one element list, shared by slots holding the same payload
+        self._hash_key = [None]
+
+    @property
+    def raw(self) -> Any:
+        return self.parent[self.key]
+
+    @property
+    def hash_key(self) -> str:
+        if self._hash_key[0] is None:
+            self._hash_key[0] = hash_string(self.value)
+        return self._hash_key[0]
+
+    def share(self, slot: "ImageSlot") -> None:
+        # an embed repeated in the project is kept in memory and hashed only once
+        if self.raw is self.value:
+            self.parent[self.key] = slot.value
+        self.value = slot.value
+        self._hash_key = slot._hash_key
+
+    def set(self, image: str) -> None:
+        self.parent[self.key] = image
+        self._load()
+
+
+class ImageIndex:
+    def __init__(self, data: Any, slots: list[ImageSlot]):
+        self.data = data
+        self.slots = slots
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def __iter__(self) -> Iterator[ImageSlot]:
+        return iter(self.slots)
+
+    def of_kind(self, *kinds: str) -> Iterator[ImageSlot]:
+        return (slot for slot in self.slots if slot.kind in kinds)
@@ -1,111 +1,163 @@
+import io
 import json
-from typing import Any, Callable
+from typing import Any, BinaryIO, Callable
 from dct.console import console
 from dct.config import Config
-from dct.hash import hash_string
+from dct.compress import WRITE_BUFFER_SIZE, open_output
+from dct.index import ImageIndex, ImageSlot, DISCORD, REMOTE, BASE64, LOCAL
 from dct.paths import get_url_components
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class NonFinite(float):
+    # NaN and Infinity, orjson would write them as null but refuses this subclass,
+    # so dump leaves documents holding them to the stdlib
+    pass
+
+
+def get_codec() -> str:
+    return "orjson" if orjson is not None else "json"
+
+
+def loads(data: bytes | bytearray | str) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # integers beyond 64 bit, NaN and Infinity are left to the stdlib
+            pass
+    return json.loads(data, parse_constant=NonFinite)
+
 
 def read_json(file_path: str) -> Any:
-    with open(file_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    if orjson is None:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    with open(file_path, "rb") as f:
+        return loads(f.read())
+
+
+def dump(json_data: Any, output: BinaryIO, minify: bool, sort_keys: bool) -> None:
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if not minify else 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            output.write(orjson.dumps(json_data, option=option))
+            return
+        except orjson.JSONEncodeError:
+            # integers beyond 64 bit and NonFinite values
+            pass
+    indent = None if minify else 2
+    separators = (",", ":") if minify else None
+    # raw utf-8 like orjson writes it, the same project gives the same bytes with
+    # either codec
+    encoder = json.JSONEncoder(
+        indent=indent, separators=separators, sort_keys=sort_keys, ensure_ascii=False
+    )
+    # a lone surrogate has no utf-8 form, it is written as the \udXXX escape
+    # ensure_ascii would have used
+    text = io.TextIOWrapper(output, encoding="utf-8", errors="backslashreplace")
+    if minify:
+        # only the one shot encoder runs in C, it needs the whole output in memory
+        encoded = encoder.encode(json_data)
+        for start in range(0, len(encoded), WRITE_BUFFER_SIZE):
+            text.write(encoded[start : start + WRITE_BUFFER_SIZE])
+    else:
+        for chunk in encoder.iterencode(json_data):
+            text.write(chunk)
+    text.flush()
+    # the caller owns the file
+    text.detach()
 
 
 def write_json(config: Config, json_data: Any) -> None:
-    with open(config.OUTPUT_PATH, "w", encoding="utf-8") as f:
-        indent = None if config.MINIFY else 2
-        separators = (",", ":") if config.MINIFY else None
+    with open_output(config) as f:
         if config.MINIFY:
             console.print("[blue]Minifying JSON...")
         console.print("[blue]Writing Output JSON...")
-        json.dump(json_data, f, indent=indent, separators=separators, sort_keys=True)
+        dump(json_data, f, config.MINIFY, config.SORT_KEYS)
 
 
-async def traverse_json(
+def traverse_json(
     data: Any, processing_function: Callable, *args: tuple, **kwargs: dict[str, Any]
-) -> Any:
-    if isinstance(data, dict):
-        await processing_function(data, *args, **kwargs)
-        for value in data.values():
-            if isinstance(value, (dict, list)):
-                await traverse_json(value, processing_function, *args, **kwargs)
-    elif isinstance(data, list):
-        for item in data:
-            await traverse_json(item, processing_function, *args, **kwargs)
-
-
-async def get_urls(json_data: Any, DISCORD_MODE: bool = False):
-    urls = {}
+) -> None:
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            processing_function(node, *args, **kwargs)
+            children = node.values()
+        elif isinstance(node, list):
+            children = node
+        else:
+            # a scalar project (null, a number, a string) has nothing to walk
+            continue
+        # reversed so dicts are still visited in document order
+        for child in reversed(children):
+            if isinstance(child, (dict, list)):
+                stack.append(child)
+
+
+def index_images(json_data: Any) -> ImageIndex:
+    slots = []
+    # payload -> first slot holding it, only kept while indexing
+    payloads = {}
+
+    def index_function(data: dict) -> None:
+        if "image" in data:
+            slot = ImageSlot(data)
+            if slot.kind == BASE64:
+                first = payloads.setdefault(slot.value, slot)
+                if first is not slot:
+                    slot.share(first)
+            slots.append(slot)
 
-    async def url_get_function(data: dict) -> None:
-        image = data.get("image", "").strip()
-        if image.startswith("http") and not image.startswith("data:image"):
-            hash_key = hash_string(image)
-            if DISCORD_MODE and "discordapp" in image:
-                urls[hash_key] = image
-            elif not DISCORD_MODE and "discordapp" not in image:
-                urls[hash_key] = image
+    traverse_json(json_data, index_function)
+    return ImageIndex(json_data, slots)
 
-    await traverse_json(json_data, url_get_function)
-    return urls
 
+def get_urls(index: ImageIndex, DISCORD_MODE: bool = False) -> dict:
+    kind = DISCORD if DISCORD_MODE else REMOTE
+    return {slot.hash_key: slot.value for slot in index.of_kind(kind)}
 
-async def get_remote_urls(data: Any, config: Config) -> dict:
-    urls = {}
-
-    async def url_get_function(data: dict, project_url: str) -> None:
-        image = data.get("image", "").strip()
-        if not image.startswith(("data:image", "http")) and image:
-            hash_key = hash_string(image)
-            base_url, _, _ = await get_url_components(project_url)
-            urls[hash_key] = f"{base_url}/{image}"
 
-    await traverse_json(data, url_get_function, config.PROJECT_URL)
+async def get_remote_urls(index: ImageIndex, config: Config) -> dict:
+    urls = {}
+    base_url, _, _ = await get_url_components(config.PROJECT_URL)
+    for slot in index.of_kind(LOCAL):
+        urls[slot.hash_key] = f"{base_url}/{slot.value}"
     return urls
 
 
-async def get_base64_strings(json_data: Any) -> dict:
-    base64_strings = {}
-
-    async def base64_string_function(data: dict) -> None:
-        image = data.get("image", "").strip()
-        if image.startswith("data:image"):
-            hash_key = hash_string(image)
-            base64_strings[hash_key] = image
-
-    await traverse_json(json_data, base64_string_function)
-    return base64_strings
+def get_base64_slots(index: ImageIndex) -> dict:
+    return {slot.hash_key: slot for slot in index.of_kind(BASE64)}
 
 
-async def update_urls(json_data: Any, url_map: dict) -> Any:
-    async def url_update_function(data: dict) -> None:
-        image = data.get("image", "").strip()
-        hash_key = hash_string(image)
-        if hash_key in url_map:
-            data["image"] = url_map[hash_key].strip()
+def update_urls(index: ImageIndex, url_map: dict) -> ImageIndex:
+    for slot in index:
+        if slot.hash_key in url_map:
+            slot.set(url_map[slot.hash_key].strip())
+    return index
 
-    await traverse_json(json_data, url_update_function)
-    return json_data
 
-
-async def update_prefixes(data: Any, config: Config) -> Any:
+def update_prefixes(index: ImageIndex, config: Config) -> ImageIndex:
     console.print("[blue] Updating Prefixes...")
 
-    async def prefix_update_function(data: dict) -> None:
-        image = data.get("image", "")
-        if image.startswith(config.OLD_PREFIX):
-            data["image"] = config.NEW_PREFIX + image[len(config.OLD_PREFIX) :]
-
-    await traverse_json(data, prefix_update_function)
-    return data
+    for slot in index:
+        image = slot.raw
+        if isinstance(image, str) and image.startswith(config.OLD_PREFIX):
+            slot.set(config.NEW_PREFIX + image[len(config.OLD_PREFIX) :])
+    return index
 
 
-async def disable_images(json_data: Any) -> Any:
+def disable_images(index: ImageIndex) -> ImageIndex:
     console.print("[bold red]Disabling...")
 
-    async def disable_image_function(data: dict) -> None:
-        if "image" in data:
-            data["image"] = ""
-
-    await traverse_json(json_data, disable_image_function)
-    return json_data
+    for slot in index:
+        slot.set("")
+    return index
@@ -0,0 +1,84 @@
+import json
+import os
+from typing import Callable, TextIO
+from dct.config import Config
+
+REFRESH_STAGE = "refresh"
+DOWNLOAD_STAGE = "download"
+BASE64_STAGE = "base64"
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class Manifest:
+    def __init__(self, path: str, resume: bool):
+        self._items = {}
+        if resume and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of a run that was killed while writing
+                        continue
+                    self._items[(item["stage"], item["key"])] = item
+        # a fresh run starts a new journal, a resumed run keeps appending to it
+        self._file: TextIO = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def get(self, stage: str, key: str) -> dict | None:
+        return self._items.get((stage, key))
+
+    def record(
+        self,
+        stage: str,
+        key: str,
+        url: str,
+        status: str,
+        retries: int = 0,
+        output: str = "",
+    ) -> None:
+        item = {
+            "stage": stage,
+            "key": key,
+            "url": url,
+            "status": status,
+            "retries": retries,
+            "output": output,
+        }
+        self._items[(stage, key)] = item
+        self._file.write(json.dumps(item) + "\n")
+        self._file.flush()
+
+    def split(
+        self, stage: str, urls: dict, valid: Callable[[str], bool] | None = None
+    ) -> tuple[dict, dict]:
+        finished = {}
+        remaining = {}
+        for key, url in urls.items():
+            item = self.get(stage, key)
+            if item and item["status"] == DONE and (not valid or valid(item["output"])):
+                finished[key] = item["output"]
+            else:
+                remaining[key] = url
+                self.record(stage, key, url, PENDING)
+        return finished, remaining
+
+    def close(self) -> None:
+        self._file.close()
+
+
+_manifests: dict[str, Manifest] = {}
+
+
+def get_manifest(config: Config) -> Manifest:
+    if config.MANIFEST_PATH not in _manifests:
+        _manifests[config.MANIFEST_PATH] = Manifest(config.MANIFEST_PATH, config.RESUME)
+    return _manifests[config.MANIFEST_PATH]
+
+
+def close_manifests() -> None:
+    for manifest in _manifests.values():
+        manifest.close()
+    _manifests.clear()
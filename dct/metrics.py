@@ -0,0 +1,192 @@
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+from dct.config import Config
+
+# stages in the order run_project goes through them
+STAGES = ("read", "refresh", "base64", "download", "convert", "embed", "write")
+
+
+class StageMetrics:
+    def __init__(self):
+        # wall time between the start and the end of the stage
+        self.seconds = 0.0
+        # time spent in the stage's own work items, they can overlap
+        self.busy_seconds = 0.0
+        self.items = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.statuses = Counter()
+        self.retries = 0
+        self.rate_limit_sleeps = 0
+        self.rate_limit_sleep_seconds = 0.0
+        self.semaphore_wait_seconds = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "seconds": round(self.seconds, 3),
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items": self.items,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+            "retries": self.retries,
+            "rate_limit_sleeps": self.rate_limit_sleeps,
+            "rate_limit_sleep_seconds": round(self.rate_limit_sleep_seconds, 3),
+            "semaphore_wait_seconds": round(self.semaphore_wait_seconds, 3),
+        }
+
+
+class Metrics:
+    def __init__(self, project: str = ""):
+        self.project = project
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.stages: dict[str, StageMetrics] = {}
+
+    def stage(self, name: str) -> StageMetrics:
+        if name not in self.stages:
+            self.stages[name] = StageMetrics()
+        return self.stages[name]
+
+    def summary(self, exit_code: int) -> dict:
+        order = {stage: index for index, stage in enumerate(STAGES)}
+        return {
+            "project": self.project,
+            "started": self.started,
+            "seconds": round(time.perf_counter() - self._start, 3),
+            "exit_code": exit_code,
+            "stages": {
+                name: self.stages[name].summary()
+                for name in sorted(self.stages, key=lambda name: order.get(name, 99))
+            },
+        }
+
+
+# metrics of the running project, every project of a batch runs in its own context
+_metrics: ContextVar[Metrics] = ContextVar("metrics")
+_run_metrics = Metrics()
+
+
+def start_metrics(project: str) -> Metrics:
+    metrics = Metrics(project)
+    _metrics.set(metrics)
+    return metrics
+
+
+def get_metrics() -> Metrics:
+    return _metrics.get(_run_metrics)
+
+
+@contextmanager
+def measure(stage: str) -> Iterator[StageMetrics]:
+    stage_metrics = get_metrics().stage(stage)
+    start = time.perf_counter()
+    try:
+        yield stage_metrics
+    finally:
+        stage_metrics.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def busy(stage: str) -> Iterator[StageMetrics]:
+    stage_metrics = get_metrics().stage(stage)
+    start = time.perf_counter()
+    try:
+        yield stage_metrics
+    finally:
+        stage_metrics.busy_seconds += time.perf_counter() - start
+
+
+def record(
+    stage: str,
+    items: int = 0,
+    bytes_in: int = 0,
+    bytes_out: int = 0,
+    status: int | str | None = None,
+    retries: int = 0,
+) -> None:
+    stage_metrics = get_metrics().stage(stage)
+    stage_metrics.items += items
+    stage_metrics.bytes_in += bytes_in
+    stage_metrics.bytes_out += bytes_out
+    stage_metrics.retries += retries
+    if status is not None:
+        stage_metrics.statuses[status] += 1
+
+
+def record_sleep(stage: str, seconds: float, sleeps: int = 1) -> None:
+    stage_metrics = get_metrics().stage(stage)
+    stage_metrics.rate_limit_sleeps += sleeps
+    stage_metrics.rate_limit_sleep_seconds += seconds
+
+
+def record_wait(stage: str, seconds: float) -> None:
+    get_metrics().stage(stage).semaphore_wait_seconds += seconds
+
+
+def write_file(path: str, content: str) -> None:
+    # renamed into place, a collector never reads a half written file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def get_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(summary: dict) -> str:
+    project = f'project="{get_label(summary["project"])}"'
+    lines = [
+        "# HELP dct_run_seconds Wall time of the whole run.",
+        "# TYPE dct_run_seconds gauge",
+        f"dct_run_seconds{{{project}}} {summary['seconds']}",
+        "# HELP dct_run_exit_code Exit status of the run.",
+        "# TYPE dct_run_exit_code gauge",
+        f"dct_run_exit_code{{{project}}} {summary['exit_code']}",
+        "# HELP dct_run_started_seconds Unix time the run started.",
+        "# TYPE dct_run_started_seconds gauge",
+        f"dct_run_started_seconds{{{project}}} {summary['started']:.3f}",
+    ]
+    metrics = (
+        ("seconds", "gauge", "Wall time of the stage."),
+        ("busy_seconds", "gauge", "Time spent in the stage's work items."),
+        ("items", "counter", "Items processed by the stage."),
+        ("bytes_in", "counter", "Bytes read by the stage."),
+        ("bytes_out", "counter", "Bytes written by the stage."),
+        ("retries", "counter", "Requests sent again."),
+        ("rate_limit_sleeps", "counter", "Sleeps caused by rate limits."),
+        ("rate_limit_sleep_seconds", "counter", "Time slept on rate limits."),
+        ("semaphore_wait_seconds", "counter", "Time spent waiting for a slot."),
+    )
+    for name, metric_type, description in metrics:
+        metric = f"dct_stage_{name}" + ("_total" if metric_type == "counter" else "")
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for stage, values in summary["stages"].items():
+            lines.append(f'{metric}{{{project},stage="{stage}"}} {values[name]}')
+    lines.append("# HELP dct_http_responses_total HTTP responses by status.")
+    lines.append("# TYPE dct_http_responses_total counter")
+    for stage, values in summary["stages"].items():
+        for status, count in values["statuses"].items():
+            lines.append(
+                f'dct_http_responses_total{{{project},stage="{stage}",'
+                f'status="{get_label(status)}"}} {count}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(config: Config, exit_code: int) -> None:
+    summary = get_metrics().summary(exit_code)
+    write_file(config.METRICS_PATH, json.dumps(summary, indent=2) + "\n")
+    if config.PROMETHEUS_FILE:
+        write_file(
+            os.path.join(config.OUTPUT_DIRECTORY, config.PROMETHEUS_FILE),
+            to_prometheus(summary),
+        )
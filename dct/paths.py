@@ -37,6 +37,10 @@ async def get_images(config: Config) -> dict | dict[str, str]:
     }
 
 
+def local_image_exists(config: Config, image_url: str) -> bool:
+    return os.path.exists(os.path.join(config.OUTPUT_DIRECTORY, image_url))
+
+
 async def get_config(directory_path: str) -> list[str]:
     files = await get_file_names(directory_path)
     return [file for file in files if file.lower().endswith(".yaml")]
@@ -0,0 +1,34 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+from dct.config import Config
+
+_executor: Executor | None = None
+
+
+def get_workers(config: Config) -> int:
+    return config.WORKERS if config.WORKERS > 0 else os.cpu_count() or 1
+
+
+def get_executor(config: Config) -> Executor:
+    global _executor
+    if _executor is None:
+        workers = get_workers(config)
+        if config.WORKER_MODE.lower() == "thread":
+            _executor = ThreadPoolExecutor(max_workers=workers)
+        else:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+async def run_in_pool(config: Config, function: Callable, *args: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(config), function, *args)
+
+
+def shutdown_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
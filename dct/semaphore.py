@@ -1,28 +1,51 @@
 import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Mapping
+from dct.metrics import record_sleep, record_wait
 
 
 class DynamicSemaphore:
-    def __init__(self, initial_count):
+    def __init__(self, initial_count, stage=""):
         self._semaphore = asyncio.Semaphore(initial_count)
         self._max_count = initial_count
-        self._lock = asyncio.Lock()
+        # metrics stage the time spent waiting for a permit is counted in
+        self._stage = stage
+        # permits to swallow on release instead of waiting for them while shrinking
+        self._debt = 0
 
     async def acquire(self):
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            return
+        start = time.perf_counter()
         await self._semaphore.acquire()
+        if self._stage:
+            record_wait(self._stage, time.perf_counter() - start)
 
     def release(self):
-        self._semaphore.release()
+        if self._debt > 0:
+            self._debt -= 1
+        else:
+            self._semaphore.release()
 
     async def update_max_count(self, new_max_count):
-        async with self._lock:
-            diff = new_max_count - self._max_count
-            if diff > 0:
-                for _ in range(diff):
-                    self._semaphore.release()
-            elif diff < 0:
-                for _ in range(-diff):
+        new_max_count = max(1, new_max_count)
+        diff = new_max_count - self._max_count
+        if diff > 0:
+            paid = min(diff, self._debt)
+            self._debt -= paid
+            for _ in range(diff - paid):
+                self._semaphore.release()
+        elif diff < 0:
+            # free permits are taken right away, permits in use are dropped when
+            # their holders release them, so callers never block here
+            for _ in range(-diff):
+                if not self._semaphore.locked():
                     await self._semaphore.acquire()
-            self._max_count = new_max_count
+                else:
+                    self._debt += 1
+        self._max_count = new_max_count
 
     async def __aenter__(self):
         await self.acquire()
@@ -30,3 +53,102 @@ class DynamicSemaphore:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         self.release()
+
+
+class Bucket:
+    def __init__(self):
+        self.limit = 1
+        self.remaining = 1
+        self.reset_at = 0.0
+        # longest reset seen, used to guess the next window before discord answers
+        self.window = 0.0
+
+
+class RateLimiter:
+    def __init__(self, concurrency: int, stage: str = ""):
+        self.semaphore = DynamicSemaphore(concurrency, stage)
+        self._stage = stage
+        # route -> discord bucket id, several routes can share one bucket
+        self._routes: dict[str, str] = {}
+        self._buckets: dict[str, Bucket] = {}
+        self._global_reset = 0.0
+        self._lock = asyncio.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.avoided = 0
+
+    def _get_bucket(self, route: str) -> Bucket | None:
+        bucket_id = self._routes.get(route)
+        return self._buckets.get(bucket_id) if bucket_id else None
+
+    async def _wait(self, route: str) -> None:
+        delayed = False
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                bucket = self._get_bucket(route)
+                if bucket and bucket.reset_at <= now:
+                    bucket.remaining = bucket.limit
+                    bucket.reset_at = now + bucket.window
+                if self._global_reset > now:
+                    delay = self._global_reset - now
+                elif bucket and bucket.remaining <= 0:
+                    delay = bucket.reset_at - now
+                else:
+                    # the slot is taken before sending, concurrent requests see it
+                    if bucket:
+                        bucket.remaining -= 1
+                    self.requests += 1
+                    return
+            if self._stage:
+                record_sleep(self._stage, max(delay, 0.01), int(not delayed))
+            if not delayed:
+                # this request would have been answered with a 429
+                self.avoided += 1
+                delayed = True
+            await asyncio.sleep(max(delay, 0.01))
+
+    @asynccontextmanager
+    async def request(self, route: str) -> AsyncIterator[None]:
+        async with self.semaphore:
+            await self._wait(route)
+            yield
+
+    def update(self, route: str, status: int | str, headers: Mapping[str, str]) -> None:
+        now = time.monotonic()
+        bucket_id = headers.get("X-RateLimit-Bucket")
+        if bucket_id:
+            self._routes[route] = bucket_id
+            bucket = self._buckets.setdefault(bucket_id, Bucket())
+            if "X-RateLimit-Limit" in headers:
+                bucket.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Reset-After" in headers:
+                reset_after = float(headers["X-RateLimit-Reset-After"])
+                reset_at = now + reset_after
+                bucket.window = max(bucket.window, reset_after)
+                remaining = int(headers.get("X-RateLimit-Remaining", bucket.limit))
+                if reset_at > bucket.reset_at + 0.5:
+                    # a new window, our own reservations belong to the old one
+                    bucket.remaining = remaining
+                else:
+                    bucket.remaining = min(bucket.remaining, remaining)
+                bucket.reset_at = max(bucket.reset_at, reset_at)
+        if status != 429:
+            return
+        self.rate_limited += 1
+        retry_after = float(
+            headers.get("Retry-After", headers.get("X-RateLimit-Reset-After", 1))
+        )
+        if (
+            headers.get("X-RateLimit-Global", "").lower() == "true"
+            or headers.get("X-RateLimit-Scope") == "global"
+        ):
+            self._global_reset = max(self._global_reset, now + retry_after)
+        else:
+            bucket = self._get_bucket(route)
+            if bucket is None:
+                bucket = self._buckets.setdefault(route, Bucket())
+                self._routes[route] = route
+            bucket.remaining = 0
+            bucket.reset_at = max(bucket.reset_at, now + retry_after)
+            bucket.window = max(bucket.window, retry_after)
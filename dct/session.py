@@ -0,0 +1,86 @@
+import aiohttp
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+from dct.config import Config
+
+_session: aiohttp.ClientSession | None = None
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.created = 0
+        self.reused = 0
+        self.requests = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_create)
+        trace_config.on_connection_reuseconn.append(self._on_reuse)
+        trace_config.on_request_start.append(self._on_request)
+        return trace_config
+
+    async def _on_create(self, session, context, params) -> None:
+        # every new connection to an https host is a tls handshake
+        self.created += 1
+
+    async def _on_reuse(self, session, context, params) -> None:
+        self.reused += 1
+
+    async def _on_request(self, session, context, params) -> None:
+        self.requests += 1
+
+    def summary(self) -> str:
+        per_connection = self.requests / self.created if self.created else 0
+        return (
+            f"Requests: {self.requests}, connections opened: {self.created}, "
+            f"reused: {self.reused}, requests per connection: {per_connection:.1f}"
+        )
+
+
+stats = ConnectionStats()
+
+
+def create_connector(config: Config, limit: int = 0) -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(
+        limit=limit or config.CONNECTION_LIMIT,
+        limit_per_host=config.CONNECTION_LIMIT_PER_HOST,
+        use_dns_cache=True,
+        ttl_dns_cache=config.DNS_CACHE_TTL,
+        keepalive_timeout=config.KEEPALIVE_TIMEOUT,
+    )
+
+
+def create_timeout(config: Config) -> aiohttp.ClientTimeout:
+    # total bounds a whole request, connect only the wait for a pooled or new
+    # connection, so a slow host cannot hold a worker for the full session time
+    return aiohttp.ClientTimeout(
+        total=config.SESSION_TIMEOUT, connect=config.CONNECT_TIMEOUT
+    )
+
+
+@asynccontextmanager
+async def open_session(**kwargs: Any) -> AsyncIterator[aiohttp.ClientSession]:
+    # every stage of a run (and every project of a batch) uses the one shared
+    # session, a session of its own is only made outside of a run
+    if _session is not None and not _session.closed:
+        yield _session
+        return
+    async with aiohttp.ClientSession(**kwargs) as session:
+        yield session
+
+
+@asynccontextmanager
+async def shared_session(
+    config: Config, limit: int = 0
+) -> AsyncIterator[aiohttp.ClientSession]:
+    global _session
+    async with aiohttp.ClientSession(
+        connector=create_connector(config, limit),
+        timeout=create_timeout(config),
+        trace_configs=[stats.trace_config()],
+    ) as session:
+        _session = session
+        try:
+            yield session
+        finally:
+            _session = None
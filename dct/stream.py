@@ -0,0 +1,276 @@
+import base64
+import json
+import re
+from typing import Any, BinaryIO, Iterator
+from dct.console import console
+from dct.config import Config
+from dct.compress import open_output
+from dct.hash import hash_string
+from dct.index import ImageIndex, classify_image, BASE64
+
+CHUNK_SIZE = 1 << 20
+# image values longer than this are not kept in memory, they are read back on demand
+CACHED_VALUE_SIZE = 1 << 12
+WHITESPACE = b" \t\r\n"
+STRING_SPECIAL = re.compile(rb'["\\]')
+# multiple of 3 so every chunk encodes to base64 without padding
+EMBED_CHUNK_SIZE = 3 << 18
+
+
+class StringScanner:
+    def __init__(self, file: BinaryIO, chunk_size: int = CHUNK_SIZE):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        # file offset of the first byte in buffer
+        self._offset = 0
+
+    def _fill(self, keep: int) -> bool:
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            return False
+        del self._buffer[: keep - self._offset]
+        self._offset = keep
+        self._buffer += chunk
+        return True
+
+    def _end(self) -> int:
+        return self._offset + len(self._buffer)
+
+    def text(self, start: int, end: int) -> bytes:
+        return bytes(self._buffer[start - self._offset : end - self._offset])
+
+    def _skip_whitespace(self, pos: int, keep: int) -> int:
+        while True:
+            while pos < self._end() and self._buffer[pos - self._offset] in WHITESPACE:
+                pos += 1
+            if pos < self._end() or not self._fill(keep):
+                return pos
+
+    def _byte(self, pos: int) -> int | None:
+        return self._buffer[pos - self._offset] if pos < self._end() else None
+
+    # yields (start, end, is_key, value_is_string) for every string token,
+    # value_is_string tells whether the value following a key is a string
+    def __iter__(self) -> Iterator[tuple[int, int, bool, bool]]:
+        pos = self._offset
+        while True:
+            index = self._buffer.find(b'"', pos - self._offset)
+            if index == -1:
+                if not self._fill(self._end()):
+                    return
+                pos = self._offset
+                continue
+            start = self._offset + index
+            pos = start + 1
+            while True:
+                match = STRING_SPECIAL.search(self._buffer, pos - self._offset)
+                if match is None or match.end() >= len(self._buffer):
+                    if match is not None and match.group() == b'"':
+                        break
+                    # the search goes on after what was scanned, a backslash at the
+                    # end is looked at again once the byte it escapes is read
+                    pos = self._offset + (
+                        match.start() if match is not None else len(self._buffer)
+                    )
+                    if not self._fill(start):
+                        raise ValueError(f"Unterminated string starting at {start}")
+                    continue
+                if match.group() == b"\\":
+                    pos = self._offset + match.end() + 1
+                    continue
+                break
+            end = self._offset + match.end()
+            pos = self._skip_whitespace(end, start)
+            is_key = self._byte(pos) == ord(":")
+            value_is_string = False
+            if is_key:
+                pos = self._skip_whitespace(pos + 1, start)
+                value_is_string = self._byte(pos) == ord('"')
+            yield start, end, is_key, value_is_string
+
+
+class FileEmbed:
+    __slots__ = ("path", "image_format")
+
+    def __init__(self, path: str, image_format: str):
+        self.path = path
+        self.image_format = image_format
+
+    def prefix(self) -> str:
+        return f"data:image/{self.image_format};base64,"
+
+    def data_uri(self) -> str:
+        with open(self.path, "rb") as f:
+            return self.prefix() + base64.b64encode(f.read()).decode("ascii")
+
+    def write(self, output: BinaryIO) -> None:
+        output.write(f'"{self.prefix()}'.encode("ascii"))
+        with open(self.path, "rb") as f:
+            while chunk := f.read(EMBED_CHUNK_SIZE):
+                output.write(base64.b64encode(chunk))
+        output.write(b'"')
+
+
+class StreamSlot:
+    __slots__ = ("path", "start", "end", "kind", "replacement", "_raw", "_hash_key")
+
+    def __init__(self, path: str, start: int, end: int, token: bytes):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.replacement = None
+        self._load(json.loads(token))
+
+    def _load(self, image: Any) -> None:
+        if isinstance(image, FileEmbed):
+            # encoded straight into the output by write_stream
+            self.kind = BASE64
+            self._hash_key = None
+            self._raw = None
+            return
+        value = image.strip() if isinstance(image, str) else ""
+        self.kind = classify_image(value)
+        self._hash_key = None
+        if len(value) > CACHED_VALUE_SIZE and self.replacement is None:
+            self._hash_key = hash_string(value)
+            self._raw = None
+        else:
+            self._raw = image
+
+    def _read(self) -> Any:
+        with open(self.path, "rb") as f:
+            f.seek(self.start)
+            return json.loads(f.read(self.end - self.start))
+
+    @property
+    def raw(self) -> Any:
+        if isinstance(self.replacement, FileEmbed):
+            return self.replacement.data_uri()
+        return self._raw if self._raw is not None else self._read()
+
+    @property
+    def value(self) -> str:
+        image = self.raw
+        return image.strip() if isinstance(image, str) else ""
+
+    @property
+    def hash_key(self) -> str:
+        if self._hash_key is None:
+            self._hash_key = hash_string(self.value)
+        return self._hash_key
+
+    def set(self, image: str | FileEmbed) -> None:
+        self.replacement = image
+        self._load(image)
+
+
+def is_empty_json(file_path: str) -> bool:
+    # the same as `not data` for a loaded project, containers are only read as far
+    # as their first item
+    with open(file_path, "rb") as f:
+        head = b""
+        while len(head) < 2 and (chunk := f.read(CHUNK_SIZE)):
+            head += chunk.translate(None, WHITESPACE)[: 2 - len(head)]
+        if not head:
+            return True
+        if head[:1] in (b"{", b"["):
+            return head in (b"{}", b"[]")
+        # a scalar project is small, it is loaded like any other
+        f.seek(0)
+        return not json.loads(f.read())
+
+
+class StreamIndex(ImageIndex):
+    def __init__(self, path: str, slots: list[StreamSlot]):
+        super().__init__("" if is_empty_json(path) else path, slots)
+        self.path = path
+
+
+def index_stream(file_path: str) -> StreamIndex:
+    slots = []
+    with open(file_path, "rb") as f:
+        scanner = StringScanner(f)
+        image_value = False
+        for start, end, is_key, value_is_string in scanner:
+            if image_value:
+                slots.append(
+                    StreamSlot(file_path, start, end, scanner.text(start, end))
+                )
+                image_value = False
+            elif is_key and value_is_string:
+                image_value = scanner.text(start, end) == b'"image"'
+    return StreamIndex(file_path, slots)
+
+
+class Minifier:
+    def __init__(self):
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        parts = []
+        pos = 0
+        while pos < len(chunk):
+            if self.escape:
+                parts.append(chunk[pos : pos + 1])
+                pos += 1
+                self.escape = False
+            elif self.in_string:
+                match = STRING_SPECIAL.search(chunk, pos)
+                if match is None:
+                    parts.append(chunk[pos:])
+                    break
+                parts.append(chunk[pos : match.end()])
+                pos = match.end()
+                if match.group() == b"\\":
+                    self.escape = True
+                else:
+                    self.in_string = False
+            else:
+                index = chunk.find(b'"', pos)
+                if index == -1:
+                    parts.append(chunk[pos:].translate(None, WHITESPACE))
+                    break
+                parts.append(chunk[pos : index + 1].translate(None, WHITESPACE))
+                pos = index + 1
+                self.in_string = True
+        return b"".join(parts)
+
+
+def copy_range(
+    source: BinaryIO,
+    output: BinaryIO,
+    start: int,
+    end: int | None,
+    minifier: Minifier | None,
+) -> None:
+    source.seek(start)
+    remaining = None if end is None else end - start
+    while remaining is None or remaining > 0:
+        size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        chunk = source.read(size)
+        if not chunk:
+            break
+        output.write(minifier.feed(chunk) if minifier else chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+
+
+def write_stream(config: Config, index: StreamIndex) -> None:
+    minifier = Minifier() if config.MINIFY else None
+    if config.MINIFY:
+        console.print("[blue]Minifying JSON...")
+    console.print("[blue]Writing Output JSON...")
+    with open(index.path, "rb") as source, open_output(config) as output:
+        pos = 0
+        for slot in index:
+            if slot.replacement is None:
+                continue
+            copy_range(source, output, pos, slot.start, minifier)
+            if isinstance(slot.replacement, FileEmbed):
+                slot.replacement.write(output)
+            else:
+                output.write(json.dumps(slot.replacement).encode("utf-8"))
+            pos = slot.end
+        copy_range(source, output, pos, None, minifier)
@@ -1,4 +1,7 @@
+import multiprocessing
 from dct import core
 
 if __name__ == '__main__':
+    # needed for the image worker processes in frozen (pyinstaller) builds
+    multiprocessing.freeze_support()
     core.run_main()
@@ -0,0 +1,74 @@
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import pytest
+from benchmarks.cdn import CdnSettings
+from benchmarks.pipeline import make_project
+
+
+def get_args(**kwargs) -> argparse.Namespace:
+    settings = {"rows": 10, "objects": 20, "remote": 0.4, "discord": 0.2}
+    settings |= {"base64": 0.2, "base64_size": 8, **kwargs}
+    return argparse.Namespace(cdn=CdnSettings(hosts=3, variants=4), **settings)
+
+
+def test_project_follows_the_shares():
+    project, counts = make_project(get_args())
+    objects = [item for row in project["rows"] for item in row["objects"]]
+    assert len(objects) == 200
+    # the golden ratio spreads the kinds evenly over the project
+    assert counts == {"remote": 80, "discord": 40, "base64": 40, "none": 40}
+    images = [item["image"] for item in objects]
+    assert sum("/cdn/" in image for image in images) == counts["remote"]
+    assert sum("discordapp" in image for image in images) == counts["discord"]
+    assert sum(image.startswith("data:image") for image in images) == counts["base64"]
+    # every host gets images, so dct sees several of them
+    assert {image.split("/")[2] for image in images if "/cdn/" in image} == {
+        f"127.0.0.{host}:8780" for host in range(1, 4)
+    }
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="uses several 127.0.0.x hosts")
+def test_pipeline_benchmark(tmp_path):
+    output = tmp_path / "results.json"
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.pipeline",
+            "--rows=2",
+            "--objects=10",
+            "--variants=2",
+            "--image-size=16",
+            "--base64-size=8",
+            "--latency=0",
+            "--slow-latency=0.05",
+            "--rate-limit-every=5",
+            f"--port={get_free_port()}",
+            "--embed",
+            f"--output={output}",
+        ],
+        check=True,
+        capture_output=True,
+        timeout=120,
+    )
+    results = json.loads(output.read_text())
+    assert [run["pass"] for run in results["passes"]] == ["process", "embed"]
+    assert all(run["exit_code"] == 0 for run in results["passes"])
+    stages = [stage["stage"] for stage in results["passes"][0]["stages"]]
+    assert {"read", "discord", "base64", "download", "write"} <= set(stages)
+    download = next(
+        stage
+        for stage in results["passes"][0]["stages"]
+        if stage["stage"] == "download"
+    )
+    # every remote image reached the fake cdn
+    assert download["requests"]["cdn_requests"] >= download["items"] > 0
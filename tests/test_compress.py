@@ -0,0 +1,93 @@
+import gzip
+import io
+import brotlicffi
+import pytest
+import zstandard
+from dct.compress import (
+    COMPRESS_CHUNK_SIZE,
+    BrotliFile,
+    GzipFile,
+    get_compress_formats,
+    open_output,
+)
+from dct.config import Config
+
+DECOMPRESS = {
+    "br": brotlicffi.decompress,
+    "gz": gzip.decompress,
+    "zst": lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+}
+
+
+def write_output(config: Config, data: bytes) -> None:
+    with open_output(config) as output:
+        # more than one compressor chunk, written in uneven pieces
+        for start in range(0, len(data), 300001):
+            output.write(data[start : start + 300001])
+
+
+def get_data() -> bytes:
+    return b"".join(
+        b'{"id": %d, "image": "images/image_%d.webp"}\n' % (i, i * 7919)
+        for i in range(COMPRESS_CHUNK_SIZE // 20)
+    )
+
+
+def test_compress_formats():
+    config = Config(COMPRESS_OUTPUT=" GZ, .br,zst,gz,")
+    assert get_compress_formats(config) == ["gz", "br", "zst"]
+    assert get_compress_formats(Config()) == []
+
+
+def test_copies_match_the_output(tmp_path):
+    config = Config(OUTPUT_DIRECTORY=str(tmp_path), COMPRESS_OUTPUT="br,gz,zst")
+    data = get_data()
+    write_output(config, data)
+    with open(config.OUTPUT_PATH, "rb") as f:
+        assert f.read() == data
+    for compress_format, decompress in DECOMPRESS.items():
+        with open(f"{config.OUTPUT_PATH}.{compress_format}", "rb") as f:
+            assert decompress(f.read()) == data
+
+
+@pytest.mark.parametrize("compress_format", ["br", "gz", "zst"])
+def test_copies_are_reproducible(tmp_path, compress_format):
+    config = Config(OUTPUT_DIRECTORY=str(tmp_path), COMPRESS_OUTPUT=compress_format)
+    data = get_data()
+    copies = []
+    for _ in range(2):
+        write_output(config, data)
+        with open(f"{config.OUTPUT_PATH}.{compress_format}", "rb") as f:
+            copies.append(f.read())
+    assert copies[0] == copies[1]
+
+
+def test_stale_copies_are_removed(tmp_path):
+    config = Config(OUTPUT_DIRECTORY=str(tmp_path), COMPRESS_OUTPUT="br,gz")
+    write_output(config, b"{}")
+    config = Config(OUTPUT_DIRECTORY=str(tmp_path), COMPRESS_OUTPUT="gz")
+    write_output(config, b"[]")
+    assert sorted(path.name for path in tmp_path.glob("project_new.json*")) == [
+        "project_new.json",
+        "project_new.json.gz",
+    ]
+
+
+class ClosingFile(io.BytesIO):
+    def close(self) -> None:
+        self.data = self.getvalue()
+        super().close()
+
+
+@pytest.mark.parametrize(
+    "compressed_file, decompress",
+    [(GzipFile, gzip.decompress), (BrotliFile, brotlicffi.decompress)],
+)
+def test_compressor_closes_its_file(compressed_file, decompress):
+    # the file is not left to the garbage collector, flush errors are raised
+    file = ClosingFile()
+    compressed = compressed_file(file, 9)
+    compressed.write(b"data")
+    compressed.close()
+    assert file.closed
+    assert decompress(file.data) == b"data"
@@ -0,0 +1,20 @@
+import pytest
+from dct.core import load_config
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["", "- OUTPUT_FILE: a.json\n", "OUTPUT_FILE: [a\n", "TYPO_KEY: 1\n", "image"],
+)
+def test_invalid_configs_are_rejected(tmp_path, text):
+    yaml_path = tmp_path / "config.yaml"
+    yaml_path.write_text(text)
+    assert load_config(str(yaml_path), False) is None
+
+
+def test_config_is_loaded(tmp_path):
+    yaml_path = tmp_path / "config.yaml"
+    yaml_path.write_text(f"OUTPUT_DIRECTORY: {tmp_path}\nMINIFY: True\n")
+    config = load_config(str(yaml_path), True)
+    assert config.MINIFY and config.RESUME
+    assert config.OUTPUT_DIRECTORY == str(tmp_path)
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import os
+import aiohttp
+import pytest
+from aiohttp import web
+from rich.progress import Progress
+from dct.config import Config
+from dct.download import PartFile, SharedDownloads, session_with_profiles
+from dct.hash import new_hash
+from dct.manifest import close_manifests
+
+DATA = hashlib.sha256(b"dct").digest() * 40000
+
+
+class FinishedTranscoder:
+    async def wait(self, image_path: str) -> str:
+        return image_path
+
+
+def test_shared_downloads_depend_on_image_settings(tmp_path):
+    fetched = []
+
+    def get_fetch(config: Config):
+        async def fetch():
+            fetched.append(config.OUTPUT_DIRECTORY)
+            with open(os.path.join(config.IMAGE_PATH, "a.webp"), "wb") as f:
+                f.write(b"image")
+            return {"a": os.path.join(config.IMAGE_FOLDER, "a.webp")}, True
+
+        return fetch
+
+    settings = [{}, {}, {"OPTIMIZE_IMAGES": True}, {"MAX_WIDTH": 100}]
+    configs = [
+        Config(OUTPUT_DIRECTORY=str(tmp_path / str(i)), CONVERT_IMAGES=True, **kwargs)
+        for i, kwargs in enumerate(settings)
+    ]
+
+    for config in configs:
+        os.makedirs(config.IMAGE_PATH)
+
+    async def main():
+        shared = SharedDownloads()
+        for config in configs:
+            result, status = await shared.download(
+                "a", "http://a", config, FinishedTranscoder(), get_fetch(config)
+            )
+            assert status
+            assert result == {"a": os.path.join(config.IMAGE_FOLDER, "a.webp")}
+            await asyncio.sleep(0)
+
+    try:
+        asyncio.run(main())
+    finally:
+        close_manifests()
+    # the second project links the file of the first one, the others differ
+    assert fetched == [configs[0].OUTPUT_DIRECTORY] + [
+        config.OUTPUT_DIRECTORY for config in configs[2:]
+    ]
+    assert os.path.exists(os.path.join(configs[1].IMAGE_PATH, "a.webp"))
+
+
+def digest(data: bytes) -> str:
+    hash_object = new_hash()
+    hash_object.update(data)
+    return hash_object.hexdigest()
+
+
+def get_part(path: str, size: int, validator: str) -> PartFile:
+    # what a run that was killed mid download leaves behind
+    with open(path, "wb") as f:
+        f.write(DATA[:size])
+    with open(f"{path}.validator", "w", encoding="utf-8") as f:
+        f.write(validator)
+    return PartFile(path)
+
+
+ETAG = '"v1"'
+
+
+def download(tmp_path, handler, part_size: int, validator: str):
+    requests = []
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        requests.append((request.headers.get("Range"), request.headers.get("If-Range")))
+        return await handler(request)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/image", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        part = get_part(str(tmp_path / "image.part"), part_size, validator)
+        try:
+            async with aiohttp.ClientSession() as session:
+                response, _ = await session_with_profiles(
+                    session,
+                    f"http://127.0.0.1:{port}/image",
+                    Progress(),
+                    "image",
+                    True,
+                    part,
+                )
+            return response.status, part, await part.commit()
+        finally:
+            await runner.cleanup()
+
+    status, part, path = asyncio.run(main())
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert part.hexdigest() == digest(DATA)
+    assert not os.path.exists(f"{path}.validator")
+    return status, requests
+
+
+async def serve_ranges(request: web.Request) -> web.StreamResponse:
+    headers = {"ETag": ETAG, "Accept-Ranges": "bytes"}
+    byte_range = request.headers.get("Range", "")
+    if not byte_range or request.headers.get("If-Range", ETAG) != ETAG:
+        return web.Response(body=DATA, headers=headers)
+    first_byte = int(byte_range.removeprefix("bytes=").rstrip("-"))
+    headers["Content-Range"] = f"bytes {first_byte}-{len(DATA) - 1}/{len(DATA)}"
+    return web.Response(status=206, body=DATA[first_byte:], headers=headers)
+
+
+def test_part_is_kept_with_its_validator(tmp_path):
+    path = str(tmp_path / "image.part")
+    part = get_part(path, 1000, ETAG)
+    assert part.size == 1000
+    assert part.validator == ETAG
+    part.write(DATA[1000:2000])
+    part.discard()
+    part = PartFile(path)
+    assert part.size == 2000
+    assert part.hexdigest() == digest(DATA[:2000])
+    part.discard()
+
+
+def test_part_without_validator_starts_over(tmp_path):
+    path = tmp_path / "image.part"
+    path.write_bytes(DATA[:1000])
+    part = PartFile(str(path))
+    assert part.size == 0
+    part.discard()
+    assert not path.exists()
+
+
+def test_resumed_download_asks_for_the_rest(tmp_path):
+    status, requests = download(tmp_path, serve_ranges, 100000, ETAG)
+    assert status == 206
+    assert requests == [("bytes=100000-", ETAG)]
+
+
+def test_changed_file_is_downloaded_whole(tmp_path):
+    # If-Range does not match, the server answers with the whole file
+    status, requests = download(tmp_path, serve_ranges, 100000, '"v0"')
+    assert status == 200
+    assert requests == [("bytes=100000-", '"v0"')]
+
+
+@pytest.mark.parametrize("first_byte", [0, 10])
+def test_wrong_content_range_is_downloaded_whole(tmp_path, first_byte):
+    async def handler(request: web.Request) -> web.StreamResponse:
+        if "Range" in request.headers:
+            return web.Response(
+                status=206,
+                body=DATA[first_byte:],
+                headers={
+                    "Content-Range": f"bytes {first_byte}-{len(DATA) - 1}/{len(DATA)}"
+                },
+            )
+        return web.Response(body=DATA)
+
+    status, requests = download(tmp_path, handler, 100000, ETAG)
+    assert status == 200
+    assert requests == [("bytes=100000-", ETAG), (None, None)]
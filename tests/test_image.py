@@ -0,0 +1,148 @@
+import asyncio
+import io
+import os
+import pytest
+from PIL import Image
+from dct.config import Config
+from dct.image import Transcoder, find_image, write_image
+
+
+def get_config(tmp_path, **kwargs) -> Config:
+    config = Config(OUTPUT_DIRECTORY=str(tmp_path), CONVERT_IMAGES=True, **kwargs)
+    os.makedirs(config.IMAGE_PATH, exist_ok=True)
+    return config
+
+
+def encode(image: Image.Image, image_format: str, **kwargs) -> bytes:
+    output = io.BytesIO()
+    image.save(output, image_format, **kwargs)
+    return output.getvalue()
+
+
+def still_png() -> bytes:
+    return encode(Image.linear_gradient("L").convert("RGB"), "PNG")
+
+
+def animated_gif(detailed: bool) -> bytes:
+    if detailed:
+        frames = [
+            Image.effect_mandelbrot((256, 256), (-2 + i / 100, -1.5, 1, 1.5), 100)
+            for i in range(8)
+        ]
+    else:
+        frames = [Image.new("L", (32, 32), i * 30) for i in range(4)]
+    frames = [frame.convert("RGB") for frame in frames]
+    return encode(
+        frames[0], "GIF", save_all=True, append_images=frames[1:], duration=80, loop=0
+    )
+
+
+def image_format(path: str) -> str:
+    with Image.open(path) as image:
+        return image.format
+
+
+def test_optimized_still_keeps_image_format(tmp_path):
+    config = get_config(tmp_path, OPTIMIZE_IMAGES=True)
+    image_path = os.path.join(config.IMAGE_PATH, "a.webp")
+    assert write_image(still_png(), image_path, config, "png") == image_path
+    assert os.listdir(config.IMAGE_PATH) == ["a.webp"]
+    # a rerun finds the file instead of encoding it again
+    mtime = os.stat(image_path).st_mtime_ns
+    assert find_image(image_path, config, "png") == image_path
+    assert write_image(still_png(), image_path, config, "png") == image_path
+    assert os.stat(image_path).st_mtime_ns == mtime
+
+
+@pytest.mark.parametrize("optimize", [False, True])
+@pytest.mark.parametrize("animated_format", ["WEBP", "AVIF"])
+def test_animation_named_after_written_format(tmp_path, animated_format, optimize):
+    config = get_config(
+        tmp_path,
+        CONVERT_ANIMATIONS=True,
+        ANIMATED_FORMAT=animated_format,
+        OPTIMIZE_IMAGES=optimize,
+    )
+    image_path = os.path.join(config.IMAGE_PATH, "a.png")
+    written = write_image(animated_gif(True), image_path, config, "gif")
+    assert written == os.path.join(config.IMAGE_PATH, f"a.{animated_format.lower()}")
+    assert image_format(written) == animated_format
+    assert find_image(image_path, config, "gif") == written
+    assert os.listdir(config.IMAGE_PATH) == [os.path.basename(written)]
+
+
+def test_small_animation_keeps_original(tmp_path):
+    config = get_config(tmp_path, CONVERT_ANIMATIONS=True, ANIMATED_FORMAT="AVIF")
+    image_path = os.path.join(config.IMAGE_PATH, "a.webp")
+    gif = animated_gif(False)
+    written = write_image(gif, image_path, config, "gif")
+    assert written == os.path.join(config.IMAGE_PATH, "a.gif")
+    with open(written, "rb") as f:
+        assert f.read() == gif
+
+
+def test_changed_format_replaces_stale_file(tmp_path):
+    gif = animated_gif(True)
+    config = get_config(tmp_path, CONVERT_ANIMATIONS=True, ANIMATED_FORMAT="AVIF")
+    image_path = os.path.join(config.IMAGE_PATH, "a.webp")
+    write_image(gif, image_path, config, "gif")
+    config = get_config(
+        tmp_path, CONVERT_ANIMATIONS=True, ANIMATED_FORMAT="WEBP", OVERWRITE_IMAGES=True
+    )
+    write_image(gif, image_path, config, "gif")
+    assert os.listdir(config.IMAGE_PATH) == ["a.webp"]
+
+
+def test_transcoder_reports_renamed_images(tmp_path):
+    config = get_config(tmp_path, CONVERT_ANIMATIONS=True, ANIMATED_FORMAT="AVIF")
+    gif_path = os.path.join(config.IMAGE_PATH, "a.webp")
+    png_path = os.path.join(config.IMAGE_PATH, "b.webp")
+
+    async def main():
+        transcoder = Transcoder(config)
+        await transcoder.submit("a", bytearray(animated_gif(True)), gif_path, "gif")
+        await transcoder.submit("b", bytearray(still_png()), png_path, "png")
+        written = await transcoder.wait(gif_path), await transcoder.wait(png_path)
+        assert await transcoder.close() == {}
+        return written, transcoder.renamed()
+
+    written, renamed = asyncio.run(main())
+    avif_path = os.path.join(config.IMAGE_PATH, "a.avif")
+    assert written == (avif_path, png_path)
+    assert renamed == {"a": avif_path}
+
+
+def photo(size: tuple[int, int]) -> Image.Image:
+    image = Image.merge(
+        "RGB",
+        [
+            Image.linear_gradient("L").resize(size),
+            Image.effect_noise(size, 40),
+            Image.radial_gradient("L").resize(size),
+        ],
+    )
+    return image
+
+
+def test_optimized_still_is_resized_and_stripped(tmp_path):
+    exif = Image.Exif()
+    exif[0x010F] = "camera"
+    original = encode(photo((400, 300)), "JPEG", quality=95, exif=exif.tobytes())
+    config = get_config(
+        tmp_path, OPTIMIZE_IMAGES=True, MAX_WIDTH=100, STRIP_METADATA=True
+    )
+    image_path = os.path.join(config.IMAGE_PATH, "a.webp")
+    write_image(original, image_path, config, "jpg")
+    with Image.open(image_path) as image:
+        assert image.size == (100, 75)
+        assert not image.getexif()
+    assert os.path.getsize(image_path) < len(original)
+
+
+def test_optimized_still_never_grows(tmp_path):
+    # a tiny palette png is hard to beat, the original is kept
+    original = encode(Image.new("P", (64, 64)), "PNG", optimize=True)
+    config = get_config(tmp_path, OPTIMIZE_IMAGES=True)
+    image_path = os.path.join(config.IMAGE_PATH, "a.webp")
+    write_image(original, image_path, config, "png")
+    assert os.path.getsize(image_path) <= len(original)
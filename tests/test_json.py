@@ -0,0 +1,88 @@
+import io
+import pytest
+import dct.json
+from dct.json import dump, index_images, loads, traverse_json
+
+
+def visited(data) -> list[dict]:
+    nodes = []
+    traverse_json(data, nodes.append)
+    return nodes
+
+
+@pytest.mark.parametrize("data", [None, 0, 1.5, True, "image", [], {}, [1, "a", None]])
+def test_scalar_and_empty_inputs(data):
+    assert visited(data) == ([{}] if data == {} else [])
+
+
+def test_document_order():
+    data = {
+        "id": 0,
+        "rows": [
+            {"id": 1, "objects": [{"id": 2}, [{"id": 3}]]},
+            {"id": 4},
+        ],
+        "extra": {"id": 5},
+    }
+    assert [node["id"] for node in visited(data)] == [0, 1, 2, 3, 4, 5]
+
+
+def test_top_level_list():
+    data = [{"id": 1}, [[{"id": 2}]], "x", {"id": 3, "nested": {"id": 4}}]
+    assert [node["id"] for node in visited(data)] == [1, 2, 3, 4]
+
+
+def test_deep_nesting():
+    data = node = {}
+    for depth in range(5000):
+        node["child"] = {"depth": depth}
+        node = node["child"]
+    assert len(visited(data)) == 5001
+
+
+def test_index_images():
+    data = {
+        "image": "https://example.com/a.png",
+        "rows": [
+            {"image": "data:image/png;base64,AAAA"},
+            {"image": "data:image/png;base64,AAAA"},
+            {"image": None},
+            {"picture": "b.png"},
+        ],
+    }
+    index = index_images(data)
+    assert [slot.kind for slot in index] == ["remote", "base64", "base64", "empty"]
+    slots = list(index)
+    # the repeated embed is hashed once and shared
+    assert slots[1].hash_key == slots[2].hash_key
+    assert len(index_images("image")) == 0
+
+
+DOCUMENTS = [
+    b'{"b": [1, 2.5, -0.0, 1e300, true, null], "a": {"z": "", "y": {}}}',
+    '{"text": "caf\u00e9 \u2615 \U0001f600 \\"q\\"", "\u00fc": []}'.encode(),
+    b'{"escaped": "\\u00e9 \\ud83d\\ude00 \\n\\t\\u0000"}',
+    b'{"lone": "\\udc80", "big": 123456789012345678901234567890}',
+    b'{"a": NaN, "b": [Infinity, -Infinity], "c": 1.5}',
+]
+
+
+def dumped(data: bytes, minify: bool, sort_keys: bool) -> bytes:
+    output = io.BytesIO()
+    dump(loads(data), output, minify, sort_keys)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize("sort_keys", [False, True])
+@pytest.mark.parametrize("minify", [False, True])
+@pytest.mark.parametrize("data", DOCUMENTS)
+def test_codecs_write_the_same_bytes(monkeypatch, data, minify, sort_keys):
+    pytest.importorskip("orjson")
+    output = dumped(data, minify, sort_keys)
+    monkeypatch.setattr(dct.json, "orjson", None)
+    assert dumped(data, minify, sort_keys) == output
+
+
+def test_non_finite_numbers_are_kept():
+    output = dumped(DOCUMENTS[-1], True, False)
+    assert output == b'{"a":NaN,"b":[Infinity,-Infinity],"c":1.5}'
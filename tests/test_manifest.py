@@ -0,0 +1,61 @@
+import json
+from dct.manifest import Manifest, DOWNLOAD_STAGE, REFRESH_STAGE, DONE, FAILED, PENDING
+
+
+def test_resume_skips_finished_items(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    manifest = Manifest(path, resume=False)
+    manifest.record(DOWNLOAD_STAGE, "a", "http://a", DONE, output="images/a.webp")
+    manifest.record(DOWNLOAD_STAGE, "b", "http://b", FAILED, 3, "http://b")
+    manifest.record(DOWNLOAD_STAGE, "c", "http://c", DONE, output="images/c.webp")
+    manifest.record(REFRESH_STAGE, "d", "http://d", DONE, output="http://d2")
+    manifest.close()
+
+    manifest = Manifest(path, resume=True)
+    urls = {key: f"http://{key}" for key in "abcde"}
+    finished, remaining = manifest.split(
+        DOWNLOAD_STAGE, urls, lambda output: output != "images/c.webp"
+    )
+    manifest.close()
+    assert finished == {"a": "images/a.webp"}
+    # failed, no longer valid, other stage and unknown items are done again
+    assert remaining == {key: urls[key] for key in "bcde"}
+
+    manifest = Manifest(path, resume=True)
+    assert manifest.get(DOWNLOAD_STAGE, "b")["status"] == PENDING
+    assert manifest.get(DOWNLOAD_STAGE, "a")["status"] == DONE
+    assert manifest.get(REFRESH_STAGE, "d")["output"] == "http://d2"
+    manifest.close()
+
+
+def test_resume_ignores_torn_last_line(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    manifest = Manifest(str(path), resume=False)
+    manifest.record(DOWNLOAD_STAGE, "a", "http://a", DONE, output="images/a.webp")
+    manifest.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"stage": "download", "key": "b", "st')
+
+    manifest = Manifest(str(path), resume=True)
+    finished, remaining = manifest.split(
+        DOWNLOAD_STAGE, {"a": "http://a", "b": "http://b"}
+    )
+    manifest.close()
+    assert finished == {"a": "images/a.webp"}
+    assert remaining == {"b": "http://b"}
+
+
+def test_fresh_run_starts_a_new_journal(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    manifest = Manifest(str(path), resume=False)
+    manifest.record(DOWNLOAD_STAGE, "a", "http://a", DONE, output="images/a.webp")
+    manifest.close()
+
+    manifest = Manifest(str(path), resume=False)
+    assert manifest.get(DOWNLOAD_STAGE, "a") is None
+    finished, remaining = manifest.split(DOWNLOAD_STAGE, {"a": "http://a"})
+    manifest.close()
+    assert finished == {}
+    assert remaining == {"a": "http://a"}
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(line["key"], line["status"]) for line in lines] == [("a", PENDING)]
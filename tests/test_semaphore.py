@@ -0,0 +1,149 @@
+import asyncio
+import pytest
+from dct.semaphore import DynamicSemaphore, RateLimiter
+
+
+async def acquired(semaphore: DynamicSemaphore) -> bool:
+    try:
+        await asyncio.wait_for(semaphore.acquire(), 0.05)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def test_shrink_does_not_block_holders():
+    async def main():
+        semaphore = DynamicSemaphore(3)
+        for _ in range(3):
+            await semaphore.acquire()
+        # every permit is in use, shrinking runs up a debt instead of waiting
+        await asyncio.wait_for(semaphore.update_max_count(1), 0.05)
+        assert semaphore._debt == 2
+        semaphore.release()
+        semaphore.release()
+        assert semaphore._debt == 0
+        assert not await acquired(semaphore)
+        semaphore.release()
+        assert await acquired(semaphore)
+        assert not await acquired(semaphore)
+
+    asyncio.run(main())
+
+
+def test_shrink_takes_free_permits():
+    async def main():
+        semaphore = DynamicSemaphore(3)
+        await semaphore.acquire()
+        await semaphore.update_max_count(2)
+        assert semaphore._debt == 0
+        assert await acquired(semaphore)
+        assert not await acquired(semaphore)
+
+    asyncio.run(main())
+
+
+def test_grow_pays_debt_first():
+    async def main():
+        semaphore = DynamicSemaphore(2)
+        await semaphore.acquire()
+        await semaphore.acquire()
+        await semaphore.update_max_count(1)
+        assert semaphore._debt == 1
+        await semaphore.update_max_count(3)
+        assert semaphore._debt == 0
+        # two held, one free
+        assert await acquired(semaphore)
+        assert not await acquired(semaphore)
+
+    asyncio.run(main())
+
+
+def test_minimum_of_one_permit():
+    async def main():
+        semaphore = DynamicSemaphore(2)
+        await semaphore.update_max_count(0)
+        assert await acquired(semaphore)
+        assert not await acquired(semaphore)
+
+    asyncio.run(main())
+
+
+def bucket_headers(bucket: str, limit: int, remaining: int, reset_after: float):
+    return {
+        "X-RateLimit-Bucket": bucket,
+        "X-RateLimit-Limit": str(limit),
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Reset-After": str(reset_after),
+    }
+
+
+async def timed_request(limiter: RateLimiter, route: str) -> float:
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with limiter.request(route):
+        pass
+    return loop.time() - start
+
+
+def test_empty_bucket_waits_for_reset():
+    async def main():
+        limiter = RateLimiter(4)
+        assert await timed_request(limiter, "a") < 0.05
+        limiter.update("a", 200, bucket_headers("b1", 2, 0, 0.2))
+        assert await timed_request(limiter, "a") >= 0.15
+        assert limiter.avoided == 1
+        assert limiter.rate_limited == 0
+        assert limiter.requests == 2
+
+    asyncio.run(main())
+
+
+def test_routes_share_a_bucket():
+    async def main():
+        limiter = RateLimiter(4)
+        limiter.update("a", 200, bucket_headers("shared", 1, 1, 0.2))
+        limiter.update("b", 200, bucket_headers("shared", 1, 1, 0.2))
+        # the last slot of the shared bucket is reserved by route a
+        assert await timed_request(limiter, "a") < 0.05
+        assert await timed_request(limiter, "b") >= 0.15
+        # a route with its own bucket is not held back
+        limiter.update("c", 200, bucket_headers("other", 1, 1, 0.2))
+        assert await timed_request(limiter, "c") < 0.05
+
+    asyncio.run(main())
+
+
+def test_reservations_are_kept_within_a_window():
+    async def main():
+        limiter = RateLimiter(4)
+        limiter.update("a", 200, bucket_headers("b1", 3, 3, 1))
+        await timed_request(limiter, "a")
+        await timed_request(limiter, "a")
+        # a late answer from the same window does not hand the slots back
+        limiter.update("a", 200, bucket_headers("b1", 3, 2, 1))
+        assert limiter._get_bucket("a").remaining == 1
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize(
+    "headers", [{"X-RateLimit-Global": "true"}, {"X-RateLimit-Scope": "global"}]
+)
+def test_global_rate_limit_holds_every_route(headers):
+    async def main():
+        limiter = RateLimiter(4)
+        limiter.update("a", 429, {"Retry-After": "0.2", **headers})
+        assert limiter.rate_limited == 1
+        assert await timed_request(limiter, "other") >= 0.15
+
+    asyncio.run(main())
+
+
+def test_rate_limited_route_without_bucket():
+    async def main():
+        limiter = RateLimiter(4)
+        limiter.update("a", 429, {"Retry-After": "0.2"})
+        assert await timed_request(limiter, "b") < 0.05
+        assert await timed_request(limiter, "a") >= 0.15
+
+    asyncio.run(main())
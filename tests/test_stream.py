@@ -0,0 +1,151 @@
+import io
+import json
+import time
+import pytest
+from dct.config import Config
+from dct.stream import Minifier, StringScanner, index_stream, write_stream
+
+PROJECT = {
+    "rows": [
+        {
+            "title": 'café ☕ "quoted" back\\slash',
+            "image": "https://example.com/a.png",
+            "objects": [{"image": "data:image/png;base64,AAAA", "id": "ü"}],
+        },
+        {"image": "", "text": "line\nbreak 😀", "count": 3},
+    ]
+}
+
+
+def scan(data: bytes, chunk_size: int) -> list[tuple[int, int, bool, bool, bytes]]:
+    scanner = StringScanner(io.BytesIO(data), chunk_size)
+    return [
+        (start, end, is_key, value_is_string, scanner.text(start, end))
+        for start, end, is_key, value_is_string in scanner
+    ]
+
+
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_scanner_offsets_are_file_bytes(chunk_size, ensure_ascii):
+    data = json.dumps(PROJECT, indent=2, ensure_ascii=ensure_ascii).encode("utf-8")
+    tokens = scan(data, chunk_size)
+    # chunk boundaries inside multi-byte characters and escapes change nothing
+    assert tokens == scan(data, len(data))
+    for start, end, _, _, text in tokens:
+        assert data[start:end] == text
+        assert isinstance(json.loads(text), str)
+
+
+def test_scanner_keys_and_values():
+    data = b'{"image" : "a", "n": 1, "list": ["image", "b"], "c":\n "d"}'
+    tokens = [token[1:] for token in scan(data, 4)]
+    assert [
+        (text, is_key, value_is_string) for _, is_key, value_is_string, text in tokens
+    ] == [
+        (b'"image"', True, True),
+        (b'"a"', False, False),
+        (b'"n"', True, False),
+        (b'"list"', True, False),
+        (b'"image"', False, False),
+        (b'"b"', False, False),
+        (b'"c"', True, True),
+        (b'"d"', False, False),
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [5, 64, 4099])
+def test_scanner_long_token(chunk_size):
+    # escapes land on every position relative to the chunk boundaries
+    value = "".join(f"{'A' * i}\\{'B' * i}\"" for i in range(300))
+    data = json.dumps({"image": value, "next": "x"}).encode("utf-8")
+    tokens = scan(data, chunk_size)
+    assert [json.loads(token[-1]) for token in tokens] == ["image", value, "next", "x"]
+
+
+def test_scanner_long_token_is_linear():
+    data = b'{"image": "' + b"A" * (1 << 23) + b'\\\\"}'
+    start = time.perf_counter()
+    tokens = scan(data, 1 << 12)
+    # rescanning the token on every refill takes minutes here
+    assert time.perf_counter() - start < 5
+    assert tokens[-1][:2] == (10, len(data) - 1)
+
+
+def test_scanner_unterminated_string():
+    with pytest.raises(ValueError):
+        scan(b'{"image": "abc', 4)
+
+
+@pytest.mark.parametrize("minify", [False, True])
+def test_stream_round_trip(tmp_path, minify):
+    project = tmp_path / "project.json"
+    project.write_bytes(
+        json.dumps(PROJECT, indent=4, ensure_ascii=False).encode("utf-8")
+    )
+    index = index_stream(str(project))
+    assert [slot.value for slot in index] == [
+        "https://example.com/a.png",
+        "data:image/png;base64,AAAA",
+        "",
+    ]
+    slot = next(iter(index))
+    slot.set("images/a.webp")
+    config = Config(OUTPUT_DIRECTORY=str(tmp_path), MINIFY=minify)
+    write_stream(config, index)
+
+    expected = json.loads(json.dumps(PROJECT))
+    expected["rows"][0]["image"] = "images/a.webp"
+    output = (tmp_path / "project_new.json").read_bytes()
+    assert json.loads(output) == expected
+    if minify:
+        assert output == json.dumps(
+            expected, ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8")
+
+
+def test_stream_unchanged_copy(tmp_path):
+    project = tmp_path / "project.json"
+    data = json.dumps(PROJECT, indent=1, ensure_ascii=False).encode("utf-8")
+    project.write_bytes(data)
+    write_stream(Config(OUTPUT_DIRECTORY=str(tmp_path)), index_stream(str(project)))
+    assert (tmp_path / "project_new.json").read_bytes() == data
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5])
+def test_minifier_escapes_split_across_chunks(chunk_size):
+    data = json.dumps(
+        {"a b": 'x \\" y\\\\', "c": [1, 2, {"d": '\\\\\\"'}], "e": "tab\t \n"},
+        indent=2,
+        ensure_ascii=False,
+    ).encode("utf-8")
+    minifier = Minifier()
+    output = b"".join(
+        minifier.feed(data[start : start + chunk_size])
+        for start in range(0, len(data), chunk_size)
+    )
+    assert output == Minifier().feed(data)
+    assert output == json.dumps(
+        json.loads(data), ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+@pytest.mark.parametrize(
+    "data, empty",
+    [
+        (b"", True),
+        (b"{}", True),
+        (b" [ \n ] ", True),
+        (b"null", True),
+        (b"0", True),
+        (b'""', True),
+        (b'{"a": 1}', False),
+        (b"[0]", False),
+        (b' "x" ', False),
+        (b"1", False),
+    ],
+)
+def test_empty_project(tmp_path, data, empty):
+    project = tmp_path / "project.json"
+    project.write_bytes(data)
+    assert not index_stream(str(project)).data == empty